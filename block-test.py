@@ -0,0 +1,196 @@
+#! /usr/bin/python3
+
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+# Checks that LDIR, LDDR, CPIR, CPDR and INIR give the same result when
+# run() does them in bulk (with block_mem) as when they are executed one
+# iteration per step().
+
+import sys
+from inspect import getframeinfo, stack
+from z80 import z80
+
+REGISTERS = ( 'a', 'f', 'b', 'c', 'd', 'e', 'h', 'l', 'ix', 'iy', 'sp', 'pc', 'memptr' )
+
+def debug(x):
+    pass
+
+def my_assert(r, what):
+    if not r:
+        caller = getframeinfo(stack()[1][0])
+        print('%s:%d: %s' % (caller.filename, caller.lineno, what))
+        sys.exit(1)
+
+class screen_none:
+    def interrupt(self):
+        pass
+
+    def IE0(self):
+        return False
+
+# 64 KB of RAM in 4 pages; page 1 is not plain memory when io_page_1 is
+# set (as the SCC or disk ROM in msx.py), so the bulk path has to stop
+# there
+class machine:
+    def __init__(self, bulk, decoded, io_page_1):
+        self.ram = bytearray(65536)
+        self.io_page_1 = io_page_1
+        self.port = 0
+
+        self.cpu = z80(self.read_mem, self.write_mem, self.read_io, self.write_io, debug, screen_none(), trace=False, decoded=decoded, block_mem=self.block_mem if bulk else None)
+
+        # no interrupts in between
+        self.cpu.interrupt_interval = 1 << 62
+
+    def read_mem(self, a):
+        return self.ram[a]
+
+    def write_mem(self, a, v):
+        self.ram[a] = v
+
+    def block_mem(self, a, write):
+        page = a >> 14
+
+        if page == 1 and self.io_page_1:
+            return None
+
+        return (self.ram, 0, page << 14, (page << 14) | 0x3fff)
+
+    # every read of an I/O port gives the next value
+    def read_io(self, a):
+        self.port = (self.port + 7) & 0xff
+
+        return self.port
+
+    def write_io(self, a, v):
+        pass
+
+    def state(self):
+        return (tuple(getattr(self.cpu, r) for r in REGISTERS), bytes(self.ram), self.port)
+
+# what run() does, but one instruction per step()
+def run_steps(cpu, max_cycles, stop_pcs):
+    done = 0
+
+    while done < max_cycles:
+        done += cpu.step()
+
+        if cpu.pc in stop_pcs:
+            break
+
+    return done
+
+# code: (address, bytes); regs: register values; memory: (address, bytes)
+def check(name, code, regs, memory=(), budgets=(1000000, ), stop_pcs=(), io_page_1=False):
+    for decoded in (False, True):
+        bulk = machine(True, decoded, io_page_1)
+        ref = machine(False, decoded, io_page_1)
+
+        for m in (bulk, ref):
+            for (a, data) in memory + (code, ):
+                m.ram[a:a + len(data)] = data
+
+            for (r, v) in regs.items():
+                setattr(m.cpu, r, v)
+
+            m.cpu.pc = code[0]
+
+        for budget in budgets:
+            took_bulk = bulk.cpu.run(budget, stop_pcs)
+            took_ref = run_steps(ref.cpu, budget, stop_pcs)
+
+            my_assert(took_bulk == took_ref, '%s: %d cycles instead of %d (budget %d)' % (name, took_bulk, took_ref, budget))
+            my_assert(bulk.state() == ref.state(), '%s: state differs after a run of %d cycles%s' % (name, budget, ' (decoded)' if decoded else ''))
+
+LDIR = bytes(( 0xed, 0xb0 ))
+LDDR = bytes(( 0xed, 0xb8 ))
+CPIR = bytes(( 0xed, 0xb1 ))
+CPDR = bytes(( 0xed, 0xb9 ))
+INIR = bytes(( 0xed, 0xb2 ))
+
+# the instruction followed by a halt (where the runs stop)
+def program(a, instr):
+    return (a, instr + b'\x76')
+
+PATTERN = bytes(range(1, 256))
+
+def test_ld():
+    # a fill: DE = HL + 1 repeats the first byte
+    check('LDIR DE = HL + 1', program(0x0000, LDIR), { 'h': 0x80, 'l': 0x00, 'd': 0x80, 'e': 0x01, 'b': 0x10, 'c': 0x00 }, ((0x8000, b'\xa5'), ), stop_pcs=(0x0002, ))
+
+    # a pattern of 3 bytes
+    check('LDIR DE = HL + 3', program(0x0000, LDIR), { 'h': 0x80, 'l': 0x00, 'd': 0x80, 'e': 0x03, 'b': 0x05, 'c': 0x55 }, ((0x8000, PATTERN), ), stop_pcs=(0x0002, ))
+
+    # the destination below the source
+    check('LDIR DE = HL - 1', program(0x0000, LDIR), { 'h': 0x80, 'l': 0x01, 'd': 0x80, 'e': 0x00, 'b': 0x01, 'c': 0x00 }, ((0x8000, PATTERN), ), stop_pcs=(0x0002, ))
+
+    check('LDDR DE = HL - 1', program(0x0000, LDDR), { 'h': 0x80, 'l': 0xff, 'd': 0x80, 'e': 0xfe, 'b': 0x01, 'c': 0x00 }, ((0x8000, PATTERN), ), stop_pcs=(0x0002, ))
+
+    check('LDDR DE = HL + 1', program(0x0000, LDDR), { 'h': 0x80, 'l': 0xfe, 'd': 0x80, 'e': 0xff, 'b': 0x01, 'c': 0x00 }, ((0x8000, PATTERN), ), stop_pcs=(0x0002, ))
+
+    # across pages and BC = 0 (64 KB)
+    check('LDIR BC = 0', program(0x0000, LDIR), { 'h': 0x80, 'l': 0x00, 'd': 0x40, 'e': 0x00, 'b': 0x00, 'c': 0x00 }, ((0x8000, PATTERN * 64), ), budgets=(10000, 100000, 1000000, 2000000))
+
+    # source and destination wrap around at 0xffff
+    check('LDIR wrap', program(0x4000, LDIR), { 'h': 0xff, 'l': 0xf0, 'd': 0xff, 'e': 0xf8, 'b': 0x00, 'c': 0x40 }, ((0xfff0, PATTERN[0:16]), (0x0000, PATTERN)), stop_pcs=(0x4002, ))
+
+    check('LDDR wrap', program(0x4000, LDDR), { 'h': 0x00, 'l': 0x08, 'd': 0x00, 'e': 0x02, 'b': 0x00, 'c': 0x40 }, ((0xffc0, PATTERN[0:64]), (0x0000, PATTERN[0:16])), stop_pcs=(0x4002, ))
+
+    # the copy overwrites the instruction itself (with NOPs; LDDR first
+    # turns it into a NEG)
+    check('LDIR over itself', program(0x8000, LDIR), { 'h': 0x70, 'l': 0x00, 'd': 0x7f, 'e': 0x00, 'b': 0x02, 'c': 0x00 }, ((0x7000, b'\x00' * 0x200), ), budgets=(100000, ), stop_pcs=(0x8100, ))
+
+    check('LDDR over itself', program(0x8000, LDDR), { 'h': 0x90, 'l': 0x00, 'd': 0x80, 'e': 0x80, 'b': 0x02, 'c': 0x00 }, ((0x8e00, b'\x00' * 0x201), (0x8f81, b'\x44')), budgets=(100000, ), stop_pcs=(0x8100, ))
+
+    # the first byte written is the second byte of the instruction, which
+    # turns into a CPIR/CPDR
+    check('LDIR over its second byte', program(0x8000, LDIR), { 'h': 0x70, 'l': 0x00, 'd': 0x80, 'e': 0x01, 'b': 0x01, 'c': 0x00 }, ((0x7000, b'\xb1'), ), stop_pcs=(0x8002, ))
+
+    check('LDDR over its second byte', program(0x8000, LDDR), { 'h': 0x70, 'l': 0x00, 'd': 0x80, 'e': 0x01, 'b': 0x01, 'c': 0x00 }, ((0x7000, b'\xb9'), ), stop_pcs=(0x8002, ))
+
+    # through memory that is not plain
+    check('LDIR not plain', program(0x0000, LDIR), { 'h': 0x3f, 'l': 0x00, 'd': 0x80, 'e': 0x00, 'b': 0x08, 'c': 0x00 }, ((0x3f00, PATTERN * 8), ), stop_pcs=(0x0002, ), io_page_1=True)
+
+def test_budget():
+    # a budget that ends in the middle of the copy, in several runs
+    check('LDIR budget', program(0x0000, LDIR), { 'h': 0x80, 'l': 0x00, 'd': 0xa0, 'e': 0x00, 'b': 0x10, 'c': 0x00 }, ((0x8000, PATTERN * 16), ), budgets=(1, 21, 22, 100, 1000, 4095, 71590, 1000000), stop_pcs=(0x0002, ))
+
+    check('LDDR budget', program(0x0000, LDDR), { 'h': 0x8f, 'l': 0xff, 'd': 0xaf, 'e': 0xff, 'b': 0x10, 'c': 0x00 }, ((0x8000, PATTERN * 16), ), budgets=(16, 37, 500, 1000000), stop_pcs=(0x0002, ))
+
+    check('CPIR budget', program(0x0000, CPIR), { 'a': 0xee, 'h': 0x80, 'l': 0x00, 'b': 0x10, 'c': 0x00 }, budgets=(1, 21, 22, 100, 1000, 1000000), stop_pcs=(0x0002, ))
+
+    check('INIR budget', program(0x0000, INIR), { 'h': 0x80, 'l': 0x00, 'b': 0x00, 'c': 0x98 }, budgets=(1, 21, 22, 100, 1000, 1000000), stop_pcs=(0x0002, ))
+
+    # the instruction itself is a stop address: one iteration per run()
+    check('LDIR stop_pcs', program(0x0000, LDIR), { 'h': 0x80, 'l': 0x00, 'd': 0xa0, 'e': 0x00, 'b': 0x00, 'c': 0x10 }, ((0x8000, PATTERN), ), budgets=(1000, ) * 20, stop_pcs=(0x0000, 0x0002))
+
+def test_cp():
+    check('CPIR found', program(0x0000, CPIR), { 'a': 0x42, 'h': 0x80, 'l': 0x00, 'b': 0x02, 'c': 0x00 }, ((0x8000, PATTERN), ), stop_pcs=(0x0002, ))
+
+    check('CPIR not found', program(0x0000, CPIR), { 'a': 0x00, 'h': 0x80, 'l': 0x00, 'b': 0x01, 'c': 0x00 }, ((0x8000, PATTERN), ), stop_pcs=(0x0002, ))
+
+    check('CPDR found', program(0x0000, CPDR), { 'a': 0x10, 'h': 0x80, 'l': 0xfe, 'b': 0x01, 'c': 0x00 }, ((0x8000, PATTERN), ), stop_pcs=(0x0002, ))
+
+    check('CPIR wrap', program(0x4000, CPIR), { 'a': 0x05, 'h': 0xff, 'l': 0xf0, 'b': 0x01, 'c': 0x00 }, ((0x0000, PATTERN), ), stop_pcs=(0x4002, ))
+
+    check('CPDR wrap', program(0x4000, CPDR), { 'a': 0xfe, 'h': 0x00, 'l': 0x10, 'b': 0x01, 'c': 0x00 }, ((0xff00, PATTERN), ), stop_pcs=(0x4002, ))
+
+    check('CPIR BC = 0', program(0x0000, CPIR), { 'a': 0x99, 'h': 0x80, 'l': 0x00, 'b': 0x00, 'c': 0x00 }, budgets=(2000000, ))
+
+    check('CPIR not plain', program(0x0000, CPIR), { 'a': 0x80, 'h': 0x3f, 'l': 0x00, 'b': 0x02, 'c': 0x00 }, ((0x3f00, PATTERN), ), stop_pcs=(0x0002, ), io_page_1=True)
+
+def test_in():
+    check('INIR', program(0x0000, INIR), { 'h': 0x80, 'l': 0x00, 'b': 0x00, 'c': 0x98 }, stop_pcs=(0x0002, ))
+
+    check('INIR wrap', program(0x4000, INIR), { 'h': 0xff, 'l': 0xc0, 'b': 0x80, 'c': 0x98 }, stop_pcs=(0x4002, ))
+
+    # INIR that overwrites itself
+    check('INIR over itself', program(0x8000, INIR), { 'h': 0x7f, 'l': 0x80, 'b': 0x00, 'c': 0x98 }, budgets=(1000, 100000), stop_pcs=(0x8002, ))
+
+test_ld()
+test_budget()
+test_cp()
+test_in()
+
+print('All fine')
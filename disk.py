@@ -1,6 +1,7 @@
 # (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
 # released under AGPL v3.0
 
+import mmap
 import struct
 import sys
 from pagetype import PageType
@@ -23,7 +24,7 @@ class disk:
         print('Loading disk rom %s...' % disk_rom_file, file=sys.stderr)
 
         fh = open(disk_rom_file, 'rb')
-        self.disk_rom = [ int(b) for b in fh.read() ]
+        self.disk_rom = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
         fh.close()
 
         self.fh = open(disk_image_file, 'ab+')
@@ -4,11 +4,20 @@
 # released under AGPL v3.0
 
 import sys
+import time
 import traceback
 from inspect import getframeinfo, stack
+from optparse import OptionParser
 from z80 import z80
 from screen_kb_dummy import screen_kb_dummy
 
+parser = OptionParser()
+parser.add_option('-T', '--trace', dest='trace', action='store_true', default=True, help='use the tracing z80 variant, with debug messages on failure (default)')
+parser.add_option('-U', '--untraced', dest='trace', action='store_false', help='use the z80 variant without tracing (no debug messages on failure)')
+parser.add_option('-L', '--lazy-flags', dest='lazy_flags', action='store_true', default=False, help='use the lazy flags z80 variant')
+parser.add_option('-P', '--decoded', dest='decoded', action='store_true', default=False, help='use generated per-opcode z80 instruction handlers')
+(options, args) = parser.parse_args()
+
 io = [ 0 ] * 256
 
 ram0 = [ 0 ] * 16384
@@ -109,7 +118,7 @@ def my_assert(f, r, what):
 dk = screen_kb_dummy(io)
 dk.start()
 
-cpu = z80(read_mem, write_mem, read_io, write_io, debug, dk)
+cpu = z80(read_mem, write_mem, read_io, write_io, debug, dk, trace=options.trace, lazy_flags=options.lazy_flags, decoded=options.decoded)
 
 # tests.in
 # --------
@@ -211,6 +220,9 @@ while True:
 
 fh = open('tests.in', 'r')
 
+n_tests = 0
+exec_time = 0.0
+
 while True:
     debug_msgs = []
 
@@ -284,9 +296,14 @@ while True:
     try:
         ccnt = 0
 
+        start = time.time()
+
         while ccnt < regs2[6]:
             ccnt += cpu.step()
 
+        exec_time += time.time() - start
+        n_tests += 1
+
         ok = True
     except:
         traceback.print_exc(file=sys.stdout)
@@ -315,3 +332,5 @@ while True:
 
         for c in m:
             my_assert(f, cpu.read_mem(c[0]) == c[1], 'mem: %04x = %02x (is: %02x)' % (c[0], c[1], cpu.read_mem(c[0]))) 
+
+print('%d tests executed in %.3f seconds' % (n_tests, exec_time))
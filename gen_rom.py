@@ -1,6 +1,7 @@
 # (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
 # released under AGPL v3.0
 
+import mmap
 import sys
 from pagetype import PageType
 
@@ -9,7 +10,7 @@ class gen_rom:
         print('Loading gen rom %s...' % gen_rom_file, file=sys.stderr)
 
         fh = open(gen_rom_file, 'rb')
-        self.gen_rom = [ int(b) for b in fh.read() ]
+        self.gen_rom = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
         fh.close()
 
         self.debug = debug
@@ -17,6 +18,17 @@ class gen_rom:
     def get_signature(self):
         return (self.gen_rom, PageType.ROM, self)
 
+    # (data, offset): the page is data[a - offset], if all of it is there
+    def page_buffer(self, page):
+        if page == 0 or (page + 1) << 14 > 0x4000 + len(self.gen_rom):
+            return None
+
+        return (self.gen_rom, 0x4000)
+
+    # (data, base, first, last) for z80.block_mem
+    def get_block(self, a):
+        return (self.gen_rom, 0x4000, 0x4000, 0x4000 + len(self.gen_rom) - 1)
+
     def write_mem(self, a, v):
         pass
 
@@ -0,0 +1,116 @@
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+import struct
+import sys
+import threading
+import zlib
+from renderer import renderer
+from vdp_core import vdp_core
+
+def png_chunk(type_, data):
+    return struct.pack('>I', len(data)) + type_ + data + struct.pack('>I', zlib.crc32(type_ + data))
+
+# rgb: height rows of width pixels of 3 bytes
+def png(width, height, rgb):
+    row_len = width * 3
+
+    # every row starts with filter type 0 (none)
+    rows = b''.join(b'\x00' + rgb[y * row_len:(y + 1) * row_len] for y in range(height))
+
+    return b'\x89PNG\r\n\x1a\n' + png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) + png_chunk(b'IDAT', zlib.compress(rows)) + png_chunk(b'IEND', b'')
+
+# Replaces screen_kb when there is no display: the VDP runs in this process
+# and, if dump is given, every dump_every-th frame is drawn into the
+# renderer's frame buffer and written to dump. When dump ends in .png it is
+# a filename pattern with the frame number (e.g. frames/%06d.png); otherwise
+# the frames are appended to it as raw RGB, '-' is stdout. The size depends
+# on the video mode (320 x 192 up to screen 3, 256 or 512 x 212 in screen
+# 5 - 8), so every raw frame starts with its width and height (2 bytes
+# each, big endian), followed by width x height x 3 bytes. No keys are
+# ever pressed.
+class headless:
+    def __init__(self, io, dump=None, dump_every=1, msx2=False):
+        self.stop_flag = False
+        self.io = io
+
+        self.debug_msg_lock = threading.Lock()
+        self.debug_msg = None
+
+        self.core = vdp_core(msx2=msx2)
+
+        self.renderer = renderer(self.core)
+
+        self.keyboard = bytearray(b'\xff' * 16)
+        self.keyboard_row = 0
+
+        self.frame_nr = 0
+
+        self.dump = dump
+        self.dump_every = dump_every
+
+        self.fh = None
+
+        # stdout is not ours to close
+        self.close_fh = dump != '-'
+
+        if dump == '-':
+            # keep the messages out of the frame stream
+            self.fh = sys.stdout.buffer
+            sys.stdout = sys.stderr
+
+        elif dump and not dump.endswith('.png'):
+            self.fh = open(dump, 'wb')
+
+    # every emulated frame, also when the cpu does not take the interrupt
+    # (DI or IE0 off), so the frame numbers follow the emulated time
+    def interrupt(self):
+        self.core.interrupt()
+
+        if self.dump and self.frame_nr % self.dump_every == 0:
+            self.write_frame()
+
+        self.frame_nr += 1
+
+    def write_frame(self):
+        self.renderer.snapshot()
+        self.renderer.draw()
+
+        rgb = self.renderer.rgb_frame()
+
+        if self.fh:
+            self.fh.write(struct.pack('>HH', self.renderer.width, self.renderer.height) + rgb)
+
+        else:
+            with open(self.dump % self.frame_nr, 'wb') as fh:
+                fh.write(png(self.renderer.width, self.renderer.height, rgb))
+
+    def IE0(self):
+        return self.core.IE0()
+
+    def write_io(self, a, v):
+        if a == 0xaa:  # PPI register C
+            self.keyboard_row = v & 15
+
+        else:
+            self.core.write_io(a, v)
+
+    def read_io(self, a):
+        if a == 0xa9:
+            return self.keyboard[self.keyboard_row]
+
+        return self.core.read_io(a)
+
+    def debug(self, str_):
+        self.debug_msg_lock.acquire()
+        self.debug_msg = str_
+        self.debug_msg_lock.release()
+
+    def stop(self):
+        self.stop_flag = True
+
+        if self.fh:
+            self.fh.flush()
+
+            if self.close_fh:
+                self.fh.close()
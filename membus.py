@@ -0,0 +1,229 @@
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+from pagetype import PageType
+
+# The memory as the z80 sees it. slots[page][slot] is the signature (data,
+# PageType, device) of what a slot has in that page, or None; for an
+# expanded slot (expanded[slot] set) it is a list of those for its 4
+# subslots. Every expanded slot has its own subslot register, at 0xffff
+# when it is selected for page 3 (reading it gives the inverted value).
+#
+# The slot per page (port 0xa8) and the subslot registers seldom change,
+# so the read and write function of each of the 4 pages is looked up only
+# then, and kept per configuration of slots and subslots for when it comes
+# back: a memory access is one call from a table. Where a page is plain ROM
+# or RAM, that is a direct index into its buffer (when the buffer starts at
+# the page's address, the buffer's own __getitem__/__setitem__); devices
+# with registers in their memory (SCC, disk) are called instead. When a
+# device changes what it has in a page (a mapper segment), only that page
+# is looked up again (remap); the other kept configurations are rebuilt
+# when they are selected next. changed (if given) is called after each
+# change of the layout.
+class membus:
+    def __init__(self, slots, debug, expanded=None, changed=None):
+        self.slots = slots
+        self.debug = debug
+        self.expanded = expanded if expanded else [ False ] * 4
+        self.changed = changed
+
+        self.pages = [ 0, 0, 0, 0 ]
+        self.subslots = [ 0, 0, 0, 0 ]
+
+        # (pages, subslots of the expanded slots) -> (readers, writers,
+        # version); version counts the remaps
+        self.tables = { }
+        self.version = 0
+
+        self.update()
+
+    # the configuration: the slot per page and for the expanded ones the
+    # subslot per page
+    def layout(self):
+        return (tuple(self.pages), tuple(self.subslots[i] if self.expanded[i] else 0 for i in range(0, 4)))
+
+    # the signature of what is selected in page
+    def resolve(self, page):
+        slot = self.pages[page]
+
+        if self.expanded[slot]:
+            return self.slots[page][slot][(self.subslots[slot] >> (page * 2)) & 3]
+
+        return self.slots[page][slot]
+
+    # call when a device changed what it has in page (e.g. a mapper)
+    def remap(self, page):
+        self.version += 1
+
+        (self.readers[page], self.writers[page]) = self.page_functions(page)
+
+        self.tables[self.key] = (self.readers, self.writers, self.version)
+
+        if self.changed:
+            self.changed()
+
+    def update(self):
+        self.key = self.layout()
+
+        table = self.tables.get(self.key)
+
+        if table == None or table[2] != self.version:
+            table = self.make_tables()
+            self.tables[self.key] = table
+
+        (self.readers, self.writers) = table[0:2]
+
+        if self.changed:
+            self.changed()
+
+    def make_tables(self):
+        readers = [ None ] * 4
+        writers = [ None ] * 4
+
+        for page in range(0, 4):
+            (readers[page], writers[page]) = self.page_functions(page)
+
+        return (readers, writers, self.version)
+
+    # (read, write) for page in the current layout
+    def page_functions(self, page):
+        slot = self.resolve(page)
+
+        region = None
+
+        if slot != None and slot[1] in (PageType.ROM, PageType.MEMMAP):
+            region = slot[2].page_buffer(page)
+
+        if slot == None:
+            read = self.read_nothing
+            write = self.write_nothing
+
+        elif region:
+            (data, offset) = region
+
+            read = self.buffer_reader(data, offset)
+
+            if slot[1] == PageType.ROM:
+                write = self.write_rom
+
+            else:
+                write = self.buffer_writer(data, offset)
+
+        elif slot[1] == PageType.SCC:
+            read = slot[2].read_mem
+            write = self.scc_writer(slot[2])
+
+        else:
+            read = slot[2].read_mem
+            write = slot[2].write_mem
+
+        # 0xffff is the subslot register of the slot in page 3, if that is
+        # expanded
+        if page == 3 and self.expanded[self.pages[3]]:
+            read = self.subslot_reader(read)
+            write = self.subslot_writer(write)
+
+        return (read, write)
+
+    def read_nothing(self, a):
+        return 0xee
+
+    def write_nothing(self, a, v):
+        self.debug('Writing %02x to %04x which is not backed by anything' % (v, a))
+
+    def write_rom(self, a, v):
+        pass
+
+    def buffer_reader(self, data, offset):
+        if offset == 0:
+            return data.__getitem__
+
+        def read(a):
+            return data[a - offset]
+
+        return read
+
+    def buffer_writer(self, data, offset):
+        if offset == 0:
+            return data.__setitem__
+
+        def write(a, v):
+            data[a - offset] = v
+
+        return write
+
+    # an SCC write may switch a bank
+    def scc_writer(self, device):
+        def write(a, v):
+            device.write_mem(a, v)
+
+            if self.changed:
+                self.changed()
+
+        return write
+
+    def subslot_reader(self, read):
+        def read_page_3(a):
+            if a == 0xffff:
+                return self.subslots[self.pages[3]] ^ 0xff
+
+            return read(a)
+
+        return read_page_3
+
+    def subslot_writer(self, write):
+        def write_page_3(a, v):
+            if a == 0xffff:
+                self.subslots[self.pages[3]] = v
+                self.update()
+
+            else:
+                write(a, v)
+
+        return write_page_3
+
+    # the subslot register at 0xffff (not inverted), 0 when page 3 is not
+    # an expanded slot
+    def subslot_register(self):
+        slot = self.pages[3]
+
+        return self.subslots[slot] if self.expanded[slot] else 0
+
+    def read_mem(self, a):
+        return self.readers[a >> 14](a)
+
+    def write_mem(self, a, v):
+        self.writers[a >> 14](a, v)
+
+    # port 0xa8
+    def read_page_layout(self, a):
+        return (self.pages[3] << 6) | (self.pages[2] << 4) | (self.pages[1] << 2) | self.pages[0]
+
+    def write_page_layout(self, a, v):
+        for i in range(0, 4):
+            self.pages[i] = (v >> (i * 2)) & 3
+
+        self.update()
+
+    # plain memory for the block instructions of the z80 (see z80.__init__)
+    def block_mem(self, a, write):
+        page = a >> 14
+
+        slot = self.resolve(page)
+        if slot == None or not slot[1] in (PageType.ROM, PageType.MEMMAP) or (write and slot[1] == PageType.ROM):
+            return None
+
+        region = slot[2].get_block(a)
+        if region == None:
+            return None
+
+        (data, base, first, last) = region
+
+        # 0xffff can be the subslot register
+        first = max(first, page << 14)
+        last = min(last, (page << 14) | 0x3fff, 0xfffe)
+
+        if a < first or a > last:
+            return None
+
+        return (data, base, first, last)
@@ -0,0 +1,150 @@
+#! /usr/bin/python3
+
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+import sys
+from inspect import getframeinfo, stack
+from membus import membus
+from memmapper import memmap
+from z80 import z80
+
+def debug(x):
+    pass
+
+def my_assert(r):
+    if not r:
+        caller = getframeinfo(stack()[1][0])
+        print('%s:%d' % (caller.filename, caller.lineno))
+        sys.exit(1)
+
+mm = memmap(256, debug)
+mm_sig = mm.get_signature()
+
+# the mapper in slot 3 of all pages, as in msx.py
+slots = ( [ None, None, None, mm_sig ], [ None, None, None, mm_sig ], [ None, None, None, mm_sig ], [ None, None, None, mm_sig ] )
+
+bus = membus(slots, debug)
+bus.write_page_layout(0xa8, 0xff)
+
+# selects a segment for a page like msx.py does for ports 0xfc - 0xff
+def select(page, segment):
+    mm.write_io(0xfc + page, segment)
+    bus.remap(page)
+
+def test_segments():
+    # different data in two segments, both through page 2
+    select(2, 5)
+    bus.write_mem(0x8000, 0x12)
+    bus.write_mem(0xbfff, 0x34)
+
+    select(2, 6)
+    my_assert(bus.read_mem(0x8000) == 0x00)
+    bus.write_mem(0x8000, 0x56)
+    bus.write_mem(0xbfff, 0x78)
+
+    select(2, 5)
+    my_assert(bus.read_mem(0x8000) == 0x12)
+    my_assert(bus.read_mem(0xbfff) == 0x34)
+
+    select(2, 6)
+    my_assert(bus.read_mem(0x8000) == 0x56)
+    my_assert(bus.read_mem(0xbfff) == 0x78)
+
+    # the last segment is not the first one either
+    select(2, 255)
+    bus.write_mem(0x8000, 0x9a)
+    select(2, 0)
+    my_assert(bus.read_mem(0x8000) != 0x9a)
+
+    my_assert(mm.read_io(0xfe) == 0)
+
+def test_remap():
+    # a segment written through page 1 shows up in page 3 after a switch
+    select(1, 7)
+    bus.write_mem(0x4123, 0xab)
+
+    select(3, 8)
+    my_assert(bus.read_mem(0xc123) == 0x00)
+
+    select(3, 7)
+    my_assert(bus.read_mem(0xc123) == 0xab)
+
+    # both pages are the same memory now
+    bus.write_mem(0xc123, 0xcd)
+    my_assert(bus.read_mem(0x4123) == 0xcd)
+
+    # a page of another slot layout that was kept from before the switch
+    bus.write_page_layout(0xa8, 0x3f)
+    select(3, 8)
+    bus.write_page_layout(0xa8, 0xff)
+    my_assert(bus.read_mem(0xc123) == 0x00)
+
+class screen_none:
+    def interrupt(self):
+        pass
+
+    def IE0(self):
+        return False
+
+def test_jit():
+    cpu = z80(bus.read_mem, bus.write_mem, lambda a: 0xff, lambda a, v: None, debug, screen_none(), trace=False, jit=True)
+    cpu.interrupt_interval = 1 << 62
+
+    # as msx.py: translations are kept per layout
+    def update_mapping():
+        cpu.mapping = (bus.key, tuple(mm.mapper))
+
+    bus.changed = update_mapping
+
+    # what msx.py does for ports 0xfc - 0xff with the jit
+    def jit_select(page, segment):
+        relocations = mm.relocations
+
+        select(page, segment)
+
+        if mm.relocations != relocations:
+            cpu.invalidate_jit()
+
+        cpu.jit_aliased = mm.aliased_pages()
+
+    # segment 9 in page 1 and 2: the code in page 1 increments the operand
+    # of its LD A,n through page 2
+    jit_select(1, 9)
+    jit_select(2, 9)
+
+    for (i, v) in enumerate(( 0x3e, 0x00, 0x3c, 0x32, 0x01, 0x80, 0xc3, 0x00, 0x40 )):  # LD A,0; INC A; LD (0x8001),A; JP 0x4000
+        bus.write_mem(0x4000 + i, v)
+
+    cpu.pc = 0x4000
+
+    for i in range(0, 10):
+        cpu.run(1000, ( 0x4000, ))
+
+    my_assert(cpu.a == 10)
+
+    # code translated in page 1 is changed through page 2 while another
+    # segment is in page 1
+    jit_select(1, 10)
+    jit_select(2, 11)
+
+    for (i, v) in enumerate(( 0x3e, 0x05, 0xc3, 0x00, 0x40 )):  # LD A,5; JP 0x4000
+        bus.write_mem(0x4000 + i, v)
+
+    cpu.run(1000, ( 0x4000, ))
+    my_assert(cpu.a == 5)
+
+    jit_select(1, 12)
+    jit_select(2, 10)
+    bus.write_mem(0x8001, 0x07)
+    jit_select(2, 11)
+    jit_select(1, 10)
+
+    cpu.run(1000, ( 0x4000, ))
+    my_assert(cpu.a == 7)
+
+test_segments()
+test_remap()
+test_jit()
+
+print('All fine')
@@ -1,10 +1,16 @@
 # (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
 # released under AGPL v3.0
 
-import sys
+import mmap
 from pagetype import PageType
 
+# Memory mapper: n_pages segments of 16 KB, selected per page with ports
+# 0xfc - 0xff. The segments are one contiguous anonymous mmap, segment s at
+# s * 16 KB; the OS only allocates the parts that are written to, so a 4 MB
+# mapper costs no more than the memory that is used.
 class memmap:
+    SEGMENT_SIZE = 16384
+
     def __init__(self, n_pages, debug):
         assert n_pages > 0 and n_pages <= 256
 
@@ -13,30 +19,69 @@ class memmap:
 
         self.mapper = [ 0, 1, 2, 3 ]
 
-        self.ram = [ [ 0 ] * 16384 ] * self.n_pages
+        # per segment the page it was last selected in, and how often a
+        # segment was selected in another page than before or in two pages
+        # at once (see relocations)
+        self.segment_page = { segment: page for page, segment in enumerate(self.mapper) }
+        self.relocations = 0
+
+        self.ram = mmap.mmap(-1, n_pages * memmap.SEGMENT_SIZE)
 
     def get_signature(self):
         return (None, PageType.MEMMAP, self)
 
+    # (data, offset): the page is data[a - offset]
+    def page_buffer(self, page):
+        segment = self.mapper[page]
+
+        if segment >= self.n_pages:
+            return None
+
+        return (self.ram, (page - segment) << 14)
+
+    # (data, base, first, last) for z80.block_mem
+    def get_block(self, a):
+        page = a >> 14
+        segment = self.mapper[page]
+
+        if segment >= self.n_pages:
+            return None
+
+        first = page << 14
+
+        return (self.ram, (page - segment) << 14, first, first + 0x3fff)
+
     def write_mem(self, a, v):
-        page = self.mapper[a >> 14]
+        segment = self.mapper[a >> 14]
 
-        if page < self.n_pages:
-            self.ram[page][a & 0x3fff] = v
+        if segment < self.n_pages:
+            self.ram[(segment << 14) | (a & 0x3fff)] = v
 
     def read_mem(self, a):
-        page = self.mapper[a >> 14]
+        segment = self.mapper[a >> 14]
 
-        if page < self.n_pages:
-            return self.ram[page][a & 0x3fff]
+        if segment < self.n_pages:
+            return self.ram[(segment << 14) | (a & 0x3fff)]
 
         return 0xee
 
+    # selects segment v for page a - 0xfc; the bus has to look that page up
+    # again (membus.remap)
     def write_io(self, a, v):
-        self.debug('memmap write %02x: %d' % (a, v), file=sys.stderr)
-        self.mapper[a - 0xfc] = v
+        self.debug('memmap write %02x: %d' % (a, v))
+
+        page = a - 0xfc
+        self.mapper[page] = v
+
+        # the segment can now be written at another address than before
+        if self.segment_page.setdefault(v, page) != page or self.mapper.count(v) > 1:
+            self.relocations += 1
+            self.segment_page = { segment: page for page, segment in enumerate(self.mapper) }
+
+    # per page 1 when its segment is also selected in another page
+    def aliased_pages(self):
+        return bytes(self.mapper.count(segment) > 1 for segment in self.mapper)
 
     def read_io(self, a):
-        self.debug('memmap read %02x' % a, file=sys.stderr)
+        self.debug('memmap read %02x' % a)
         return self.mapper[a - 0xfc]
-
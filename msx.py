@@ -3,17 +3,17 @@
 # (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
 # released under AGPL v3.0
 
+import atexit
 import sys
 import threading
 import time
 from disk import disk
 from gen_rom import gen_rom
-from pagetype import PageType
 from scc import scc
 from z80 import z80
-from screen_kb import screen_kb
-from sound import sound
+from membus import membus
 from memmapper import memmap
+from pacer import pacer
 from rom import rom
 from optparse import OptionParser
 
@@ -25,10 +25,11 @@ io_values = [ 0 ] * 256
 io_read = [ None ] * 256
 io_write = [ None ] * 256
 
-subpage = 0x00
+bus = None
 
 def debug(x):
-    global subpage
+    subpage = bus.subslot_register() if bus else 0
+
     dk.debug('%s <%02x/%02x>' % (x, io_values[0xa8], subpage))
 
     if debug_log:
@@ -39,19 +40,60 @@ def debug(x):
 mm = memmap(256, debug)
 mm_sig = mm.get_signature()
 
-slot_0 = [ None, None, None, mm_sig ]
-slot_1 = [ None, None, None, mm_sig ]
-slot_2 = [ None, None, None, mm_sig ]
-slot_3 = [ None, None, None, mm_sig ]
+slot_0 = [ None, None, None, None ]
+slot_1 = [ None, None, None, None ]
+slot_2 = [ None, None, None, None ]
+slot_3 = [ None, None, None, None ]
+
+# per primary slot: has 4 subslots (see membus)
+expanded = [ False, False, False, False ]
+
+# spec is a slot ("1") or a slot and subslot ("3-2"); puts sig in that slot
+# in the given pages. A slot becomes expanded at its first subslot, what was
+# in it then moves to subslot 0.
+def place(spec, pages, sig):
+    parts = spec.split('-')
+    slot = int(parts[0])
+
+    for page in pages:
+        if len(parts) == 1:
+            if expanded[slot]:
+                page[slot][0] = sig
+
+            else:
+                page[slot] = sig
+
+        else:
+            if not expanded[slot]:
+                for p in ( slot_0, slot_1, slot_2, slot_3 ):
+                    p[slot] = [ p[slot], None, None, None ]
+
+                expanded[slot] = True
+
+            page[slot][int(parts[1])] = sig
 
 bb_file = None
 
 parser = OptionParser()
 parser.add_option('-b', '--biosbasic', dest='bb_file', help='select BIOS/BASIC ROM')
 parser.add_option('-l', '--debug-log', dest='debug_log', help='logfile to write to (optional)')
-parser.add_option('-R', '--rom', dest='rom', help='select a simple ROM to use, format: slot:rom-filename')
+parser.add_option('-R', '--rom', dest='rom', help='select a simple ROM to use, format: slot:rom-filename (slot is e.g. 1, or 3-1 for subslot 1 of slot 3)')
 parser.add_option('-S', '--scc-rom', dest='scc_rom', help='select an SCC ROM to use, format: slot:rom-filename')
 parser.add_option('-D', '--disk-rom', dest='disk_rom', help='select a disk ROM to use, format: slot:rom-filename:disk-image.dsk')
+parser.add_option('-M', '--mapper-slot', dest='mapper_slot', default='3', help='slot of the memory mapper (default 3, e.g. 3-0 for subslot 0 of slot 3)')
+parser.add_option('-T', '--trace', dest='trace', action='store_true', default=False, help='trace every instruction to the debug output (slow)')
+parser.add_option('-L', '--lazy-flags', dest='lazy_flags', action='store_true', default=False, help='calculate the z80 flags only when they are used')
+parser.add_option('-P', '--decoded', dest='decoded', action='store_true', default=False, help='use generated per-opcode z80 instruction handlers')
+parser.add_option('-J', '--jit', dest='jit', action='store_true', default=False, help='translate basic blocks of z80 code to python functions')
+parser.add_option('-f', '--refresh', dest='refresh', type='int', default=50, help='video frame rate: 50 (PAL, default) or 60 (NTSC)')
+parser.add_option('-s', '--speed', dest='speed', type='float', default=1.0, help='run at this multiple of the real speed (default 1.0)')
+parser.add_option('-x', '--turbo', dest='turbo', action='store_true', default=False, help='run as fast as possible')
+parser.add_option('-v', '--report-speed', dest='report_speed', type='float', help='print the achieved speed every this many seconds')
+parser.add_option('-F', '--profile', dest='profile', help='count the executed z80 instructions and write a report to this file at exit (JSON when it ends in .json); not with -J, a bulk LDIR/LDDR/CPIR/CPDR/INIR counts once')
+parser.add_option('-2', '--msx2', dest='msx2', action='store_true', default=False, help='emulate a V9938 (MSX2) VDP: 128 KB VRAM, palette, screen 5 - 8 and the command engine')
+parser.add_option('-H', '--headless', dest='headless', action='store_true', default=False, help='no window, keyboard and sound (no pygame/pyaudio needed)')
+parser.add_option('-o', '--dump', dest='dump', help='headless: write frames to this file as raw RGB (- is stdout; per frame the width and height as 2 big endian bytes each, then width x height x 3 bytes: 320x192 up to screen 3, 256x212 or 512x212 in screen 5 - 8), or as PNG files when it ends in .png: then it must contain the frame number, e.g. frame%06d.png')
+parser.add_option('-n', '--dump-every', dest='dump_every', type='int', default=1, help='headless: only write every n-th frame')
 (options, args) = parser.parse_args()
 
 debug_log = options.debug_log
@@ -60,86 +102,76 @@ if not options.bb_file:
     print('No BIOS/BASIC ROM selected (e.g. msxbiosbasic.rom)')
     sys.exit(1)
 
+# the profiler counts what the interpreter executes
+if options.profile and options.jit:
+    print('The profiler (-F) can not be combined with the jit (-J)')
+    sys.exit(1)
+
+# a PNG file per frame: the name needs the frame number
+if options.dump and options.dump.endswith('.png'):
+    try:
+        options.dump % 0
+
+    except (TypeError, ValueError):
+        print('The PNG file name of -o needs the frame number in it, e.g. frame%06d.png')
+        sys.exit(1)
+
 # bb == bios/basic
 bb = rom(options.bb_file, debug, 0x0000)
 bb_sig = bb.get_signature()
-slot_0[0] = bb_sig
-slot_1[0] = bb_sig
+place('0', ( slot_0, slot_1 ), bb_sig)
+
+place(options.mapper_slot, ( slot_0, slot_1, slot_2, slot_3 ), mm_sig)
 
-snd = sound(debug)
+if options.headless:
+    snd = None
+
+else:
+    from sound import sound
+    snd = sound(debug)
+
+scc_obj = None
 
 if options.scc_rom:
     parts = options.scc_rom.split(':')
     scc_obj = scc(parts[1], snd, debug)
     scc_sig = scc_obj.get_signature()
-    scc_slot = int(parts[0])
-    slot_1[scc_slot] = scc_sig
-    slot_2[scc_slot] = scc_sig
+    place(parts[0], ( slot_1, slot_2 ), scc_sig)
 
 if options.disk_rom:
     parts = options.disk_rom.split(':')
-    disk_slot = int(parts[0])
     disk_obj = disk(parts[1], debug, parts[2])
-    slot_1[disk_slot] = disk_obj.get_signature()
+    place(parts[0], ( slot_1, ), disk_obj.get_signature())
 
 if options.rom:
     parts = options.rom.split(':')
-    rom_slot = int(parts[0])
     rom_obj = gen_rom(parts[1], debug)
     rom_sig = rom_obj.get_signature()
-    slot_1[rom_slot] = rom_sig
-    if len(rom_sig[0]) >= 32768:
-        slot_2[rom_slot] = rom_sig
-
-subpage = 0x00
+    place(parts[0], ( slot_1, slot_2 ) if len(rom_sig[0]) >= 32768 else ( slot_1, ), rom_sig)
 
 slots = ( slot_0, slot_1, slot_2, slot_3 )
 
-pages = [ 0, 0, 0, 0 ]
-
-def read_mem(a):
-    global subpage
+bus = membus(slots, debug, expanded)
 
-    if a == 0xffff:
-        return subpage
+# the jit caches translated code per memory layout, including the mapper
+# segments
+def update_mapping():
+    cpu.mapping = (bus.key, tuple(mm.mapper), tuple(scc_obj.scc_pages) if scc_obj else None)
 
-    page = a >> 14
+def write_memmap(a, v):
+    relocations = mm.relocations
 
-    slot = slots[page][pages[page]]
-    if slot == None:
-        return 0xee
+    mm.write_io(a, v)
 
-    if len(slot) != 3:
-        print(len(slot), a)
+    bus.remap(a - 0xfc)
 
-    return slot[2].read_mem(a)
+    if options.jit:
+        # a segment that moved to another page, or is in two pages, can be
+        # written at an address the jit did not translate it for
+        if mm.relocations != relocations:
+            cpu.invalidate_jit()
 
-def write_mem(a, v):
-    global subpage
-
-    if not (v >= 0 and v <= 255):
-        print(v, file=sys.stderr)
-    assert v >= 0 and v <= 255
-
-    if a == 0xffff:
-        subpage = v
-        return
-
-    page = a >> 14
-
-    slot = slots[page][pages[page]]
-    if slot == None:
-        debug('Writing %02x to %04x which is not backed by anything' % (v, a))
-        return
-    
-    slot[2].write_mem(a, v)
-
-def read_page_layout(a):
-    return (pages[3] << 6) | (pages[2] << 4) | (pages[1] << 2) | pages[0]
-
-def write_page_layout(a, v):
-    for i in range(0, 4):
-        pages[i] = (v >> (i * 2)) & 3
+        cpu.jit_aliased = mm.aliased_pages()
 
 def printer_out(a, v):
     # FIXME handle strobe
@@ -152,9 +184,10 @@ def init_io():
 
     if dk:
         print('set screen')
-        for i in (0x98, 0x99, 0x9a, 0x9b):
-            io_read[i] = dk.read_io
-            io_write[i] = dk.write_io
+        # the VDP ports go straight to its core
+        for i in (0x98, 0x99, 0x9a, 0x9b) if options.msx2 else (0x98, 0x99):
+            io_read[i] = dk.core.read_io
+            io_write[i] = dk.core.write_io
 
         io_read[0xa9] = dk.read_io
 
@@ -169,11 +202,11 @@ def init_io():
     print('set mm')
     for i in range(0xfc, 0x100):
         io_read[i] = mm.read_io
-        io_write[i] = mm.write_io
+        io_write[i] = write_memmap
 
     print('set mm')
-    io_read[0xa8] = read_page_layout
-    io_write[0xa8] = write_page_layout
+    io_read[0xa8] = bus.read_page_layout
+    io_write[0xa8] = bus.write_page_layout
 
     print('set printer')
     io_write[0x91] = printer_out
@@ -196,15 +229,42 @@ def write_io(a, v):
 
 stop_flag = False
 
+pace = pacer(options.refresh, None if options.turbo else options.speed)
+
 def cpu_thread():
-    #t = time.time()
-    #while time.time() - t < 5:
+    next_report = time.time() + options.report_speed if options.report_speed else None
+
     while not stop_flag:
-        cpu.step()
+        pace.wait(cpu.run(pace.frame_cycles))
 
-dk = screen_kb(io_values)
+        if next_report and time.time() >= next_report:
+            speed = 'speed: %.1f%% of a %d Hz MSX' % (pace.achieved(), options.refresh)
 
-cpu = z80(read_mem, write_mem, read_io, write_io, debug, dk)
+            # headless there is no display process to send messages to
+            if not options.headless:
+                speed += ', %.1f frames per display message' % dk.messages_per_syscall()
+
+            print(speed, file=sys.stderr)
+            next_report += options.report_speed
+
+if options.headless:
+    from headless import headless
+    dk = headless(io_values, options.dump, options.dump_every, options.msx2)
+
+else:
+    from screen_kb import screen_kb
+    dk = screen_kb(io_values, options.msx2)
+
+cpu = z80(bus.read_mem, bus.write_mem, read_io, write_io, debug, dk, trace=options.trace, lazy_flags=options.lazy_flags, decoded=options.decoded, jit=options.jit, profile=options.profile != None, block_mem=bus.block_mem)
+
+if options.jit:
+    bus.changed = update_mapping
+
+# one frame of the pacer is one VDP interrupt
+cpu.interrupt_interval = pace.frame_cycles
+
+if options.profile:
+    atexit.register(cpu.write_profile, options.profile)
 
 init_io()
 
@@ -223,7 +283,3 @@ except KeyboardInterrupt:
     t.join()
 
 dk.stop()
-
-#for i in range(0, 256):
-#    if cpu.counts[i]:
-#        print('instr %02x: %d' % (i, cpu.counts[i]), file=sys.stderr)
@@ -0,0 +1,60 @@
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+import time
+
+Z80_CLOCK = 3579545
+
+# Keeps the emulation in step with the wall clock: the cpu runs one video
+# frame (1/50 or 1/60 s) worth of cycles at a time and wait() then sleeps
+# until that frame is due. speed is a multiplier of the real speed of an
+# MSX; None runs as fast as possible (turbo). When the emulation falls
+# more than max_behind frames behind (e.g. a slow host), it does not try
+# to catch up but continues from the current time.
+class pacer:
+    def __init__(self, hz=50, speed=1.0, max_behind=5):
+        self.hz = hz
+        self.speed = speed
+        self.max_behind = max_behind
+
+        self.frame_cycles = Z80_CLOCK // hz
+
+        self.next_frame = time.monotonic()
+
+        self.cycles = 0
+
+        self.report_time = self.next_frame
+        self.report_cycles = 0
+
+    # call after each frame, with the number of cycles it actually took
+    def wait(self, cycles):
+        self.cycles += cycles
+
+        if not self.speed:
+            return
+
+        self.next_frame += cycles / (Z80_CLOCK * self.speed)
+
+        now = time.monotonic()
+
+        if self.next_frame > now:
+            time.sleep(self.next_frame - now)
+
+        elif now - self.next_frame > self.max_behind / self.hz:
+            self.next_frame = now
+
+    # emulated speed relative to a real MSX since the previous call, in
+    # percent
+    def achieved(self):
+        now = time.monotonic()
+
+        took = now - self.report_time
+        cycles = self.cycles - self.report_cycles
+
+        self.report_time = now
+        self.report_cycles = self.cycles
+
+        if took <= 0:
+            return 0.0
+
+        return cycles * 100.0 / took / Z80_CLOCK
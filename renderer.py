@@ -0,0 +1,429 @@
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+# draws the VDP (vdp_core) state into a frame buffer, without pygame
+
+import numpy as np
+from sprites import sprites
+from tile_cache import tile_cache
+
+class renderer:
+    # screen 5 - 8 (video_mode()): pixels per byte, bytes per line
+    BITMAP = { 9: (2, 128), 16: (4, 128), 17: (2, 256), 25: (1, 256) }
+
+    # core is a vdp_core (possibly on shared memory); each frame is drawn
+    # from a snapshot of its VRAM, registers and dirty map, after which
+    # snapshot_taken is called (if given)
+    def __init__(self, core, snapshot_taken=None):
+        self.core = core
+
+        self.snapshot_taken = snapshot_taken
+
+        self.snapshot()
+
+        # registers of the last drawn frame; None: draw everything
+        self.drawn_registers = None
+
+        # cells drawn in the last frame, frames drawn and frames skipped
+        # (nothing changed)
+        self.cells_drawn = 0
+        self.frames_drawn = 0
+        self.frames_skipped = 0
+
+        # TMS9918 palette 
+        self.rgb = ( self.rgb_to_i(0, 0, 0), self.rgb_to_i(0, 0, 0), self.rgb_to_i(33, 200, 66), self.rgb_to_i(94, 220, 120), self.rgb_to_i(84, 85, 237), self.rgb_to_i(125, 118, 252), self.rgb_to_i(212, 82, 77), self.rgb_to_i(66, 235, 245), self.rgb_to_i(252, 85, 84), self.rgb_to_i(255, 121, 120), self.rgb_to_i(212, 193, 84), self.rgb_to_i(231, 206, 128), self.rgb_to_i(33, 176, 59), self.rgb_to_i(201, 91, 186), self.rgb_to_i(204, 204, 204), self.rgb_to_i(255, 255, 255) )
+
+        # the frame, as 0xRRGGBB per (x, y), in the upper left width x
+        # height pixels: 320 x 192 up to screen 3, 256 or 512 x 192 or 212
+        # for the bitmap modes
+        self.arr = np.zeros((512, 212), dtype=np.uint32)
+
+        self.width = 320
+        self.height = 192
+
+        self.palette = np.array(self.rgb, dtype=self.arr.dtype)
+
+        # V9938: the palette registers of the last drawn frame; screen 8
+        # has fixed colors (GGGRRRBB)
+        self.drawn_palette = None
+
+        v = np.arange(256)
+        self.g7_palette = self.rgb_to_i(((v >> 2) & 7) * 255 // 7, (v >> 5) * 255 // 7, (v & 3) * 255 // 3).astype(self.arr.dtype)
+
+        self.screen2_thirds = (np.arange(32 * 24) >> 8) * 256
+        self.tile_rows = np.arange(8)
+
+        self.atlas = None
+        self.atlas_key = None
+
+        # screen 2: the drawn tile per character (3 * 256) and the 8 pattern
+        # and 8 color bytes it was drawn from; valid until they are written
+        # to. The tile_cache has the recently drawn ones by content.
+        self.screen2_tiles = np.zeros((3 * 256, 8, 8), dtype=self.arr.dtype)
+        self.screen2_keys = np.zeros((3 * 256, 16), dtype=np.uint8)
+        self.screen2_valid = np.zeros(3 * 256, dtype=bool)
+        self.tile_cache = tile_cache()
+
+        self.sprites = sprites()
+
+    def rgb_to_i(self, r, g, b):
+        return (r << 16) | (g << 8) | b
+
+    def snapshot(self):
+        self.ram = bytes(self.core.ram)
+        self.registers = bytes(self.core.registers)
+        self.palette_registers = bytes(self.core.palette)
+
+        self.dirty = np.frombuffer(bytes(self.core.dirty), dtype=np.uint8)
+        self.core.dirty[:] = bytes(len(self.core.dirty))
+
+        if self.snapshot_taken:
+            self.snapshot_taken()
+
+    def video_mode(self):
+        m1 = (self.registers[1] >> 4) & 1;
+        m2 = (self.registers[1] >> 3) & 1;
+        m3 = (self.registers[0] >> 1) & 1;
+        m4 = (self.registers[0] >> 2) & 1;
+        m5 = (self.registers[0] >> 3) & 1;
+
+        return (m5 << 4) | (m4 << 3) | (m1 << 2) | (m2 << 1) | m3
+
+    # V9938: the palette from the palette registers (3 bits per component)
+    def set_palette(self):
+        p = np.frombuffer(self.palette_registers, dtype=np.uint8).reshape(16, 2).astype(np.uint32)
+
+        self.palette = self.rgb_to_i((p[:, 0] >> 4) * 255 // 7, p[:, 1] * 255 // 7, (p[:, 0] & 7) * 255 // 7).astype(self.arr.dtype)
+
+        self.drawn_palette = self.palette_registers
+
+        # the drawn screen 2 tiles have the old colors
+        self.tile_cache.clear()
+
+        bits = np.unpackbits(self.screen2_keys[:, 0:8, None], axis=2)
+        colors = self.screen2_keys[:, 8:16]
+
+        self.screen2_tiles[:] = np.where(bits, self.palette[colors >> 4][:, :, None], self.palette[colors & 15][:, :, None])
+
+        self.atlas_key = None
+
+    def sprites_dirty(self):
+        attr = (self.registers[5] & 127) << 7
+        patt = (self.registers[6] & 7) << 11
+
+        return self.dirty_blocks(attr, 128 // 8).any() or self.dirty_blocks(patt, 2048 // 8).any()
+
+    # n blocks of 8 bytes from offset: which have been written to
+    def dirty_blocks(self, offset, n):
+        return self.dirty[offset >> 3:(offset >> 3) + n]
+
+    # returns the number of cells drawn
+    def draw_screen2(self, full):
+        bg_map    = (self.registers[2] &  15) << 10
+        bg_colors = (self.registers[3] & 128) <<  6
+        bg_tiles  = (self.registers[4] &   4) << 11
+
+        ram = np.frombuffer(self.ram, dtype=np.uint8)
+
+        # each third of the screen has its own 256 patterns and colors
+        chars = ram[bg_map:bg_map + 32 * 24] + self.screen2_thirds
+
+        which = None
+
+        if not full:
+            changed = self.dirty_blocks(bg_map, 96).repeat(8) | self.dirty_blocks(bg_tiles, 768)[chars] | self.dirty_blocks(bg_colors, 768)[chars]
+
+            which = np.flatnonzero(changed)
+            if len(which) == 0:
+                return 0
+
+            chars = chars[which]
+
+        self.update_screen2_tiles(ram, bg_tiles, bg_colors, chars, full)
+
+        self.put_cells(self.screen2_tiles[chars], 32, which)
+
+        return len(chars)
+
+    # draws the tiles of the characters in chars that are not valid and
+    # whose pattern or colors differ from what they were drawn from: from
+    # the tile_cache or, when not in there, from the pattern and color table
+    def update_screen2_tiles(self, ram, bg_tiles, bg_colors, chars, full):
+        # full: the tables may have moved or changed while not drawing
+        # screen 2, check all of them
+        if full:
+            self.screen2_valid[:] = False
+
+        else:
+            self.screen2_valid &= (self.dirty_blocks(bg_tiles, 768) | self.dirty_blocks(bg_colors, 768)) == 0
+
+        used = np.zeros(3 * 256, dtype=bool)
+        used[chars] = True
+
+        slots = np.flatnonzero(used & ~self.screen2_valid)
+        if len(slots) == 0:
+            return
+
+        self.screen2_valid[slots] = True
+
+        # (n, 8): for every character the VRAM offset of its 8 rows
+        rows = slots[:, None] * 8 + self.tile_rows
+
+        keys = np.concatenate((ram[bg_tiles + rows], ram[bg_colors + rows]), axis=1)
+
+        changed = np.any(keys != self.screen2_keys[slots], axis=1)
+
+        slots = slots[changed]
+        if len(slots) == 0:
+            return
+
+        keys = keys[changed]
+
+        self.screen2_keys[slots] = keys
+
+        key_bytes = keys.tobytes()
+
+        missing = []
+
+        for i in range(len(slots)):
+            tile = self.tile_cache.get(key_bytes[i * 16:i * 16 + 16])
+
+            if tile is None:
+                missing.append(i)
+
+            else:
+                self.screen2_tiles[slots[i]] = tile
+
+        if missing:
+            bits = np.unpackbits(keys[missing, 0:8, None], axis=2)
+            colors = keys[missing, 8:16]
+
+            fg = self.palette[colors >> 4]
+            bg = self.palette[colors & 15]
+
+            pixels = np.where(bits, fg[:, :, None], bg[:, :, None])
+
+            self.screen2_tiles[slots[missing]] = pixels
+
+            for j, i in enumerate(missing):
+                self.tile_cache.put(key_bytes[i * 16:i * 16 + 16], pixels[j])
+
+    # (256, 8, 8) pixels of all characters from the pattern table at
+    # bg_tiles and a color byte per character; only rebuilt when those
+    # change
+    def glyph_atlas(self, bg_tiles, colors):
+        key = (self.ram[bg_tiles:bg_tiles + 256 * 8], colors.tobytes())
+
+        if key != self.atlas_key:
+            patterns = np.frombuffer(key[0], dtype=np.uint8)
+            bits = np.unpackbits(patterns.reshape(256, 8, 1), axis=2)
+
+            fg = self.palette[colors >> 4]
+            bg = self.palette[colors & 15]
+
+            self.atlas = np.where(bits, fg[:, None, None], bg[:, None, None])
+            self.atlas_key = key
+
+        return self.atlas
+
+    # cells is (n, 8, 8): all cells in name table order or, when which is
+    # given, the cells with those indices
+    def put_cells(self, cells, cols, which=None):
+        if which is None:
+            self.arr[0:cols * 8, 0:192] = cells.reshape(24, cols, 8, 8).transpose(1, 3, 0, 2).reshape(cols * 8, 192)
+
+        else:
+            x = (which % cols * 8)[:, None, None] + self.tile_rows[None, :, None]
+            y = (which // cols * 8)[:, None, None] + self.tile_rows[None, None, :]
+
+            self.arr[x, y] = cells.transpose(0, 2, 1)
+
+    # cells of the name table at bg_map with characters from the pattern
+    # table at bg_tiles (and colors) that changed, None for all
+    def changed_cells(self, full, bg_map, cols, bg_tiles, chars, colors_changed=None):
+        if full:
+            return None
+
+        changed = self.dirty_blocks(bg_map, cols * 24 // 8).repeat(8) | self.dirty_blocks(bg_tiles, 256)[chars]
+
+        if colors_changed is not None:
+            changed |= colors_changed[chars]
+
+        return np.flatnonzero(changed)
+
+    def draw_text(self, full):
+        cols = 40  # FIXME
+
+        bg_map = (self.registers[2] & 0x7c) << 10 if cols == 80 else (self.registers[2] & 15) << 10
+        bg_tiles = (self.registers[4] & 7) << 11
+
+        ram = np.frombuffer(self.ram, dtype=np.uint8)
+
+        chars = ram[bg_map:bg_map + cols * 24]
+
+        which = self.changed_cells(full, bg_map, cols, bg_tiles, chars)
+
+        return self.draw_chars(chars, cols, which, bg_tiles, np.full(256, self.registers[7], dtype=np.uint8))
+
+    def draw_chars(self, chars, cols, which, bg_tiles, colors):
+        if which is not None:
+            if len(which) == 0:
+                return 0
+
+            chars = chars[which]
+
+        self.put_cells(self.glyph_atlas(bg_tiles, colors)[chars], cols, which)
+
+        return len(chars)
+
+    def draw_screen1(self, full):
+        bg_map    = (self.registers[2] &  15) << 10;
+        bg_colors = (self.registers[3] & 128) <<  6
+        bg_tiles  = (self.registers[4] &   4) << 11
+
+        ram = np.frombuffer(self.ram, dtype=np.uint8)
+
+        chars = ram[bg_map:bg_map + 32 * 24]
+
+        # one color byte per 8 characters, so a block of them per 64
+        which = self.changed_cells(full, bg_map, 32, bg_tiles, chars, self.dirty_blocks(bg_colors, 4).repeat(64))
+
+        return self.draw_chars(chars, 32, which, bg_tiles, ram[bg_colors:bg_colors + 32].repeat(8))
+
+    # 'screen 3': every character is 2 x 2 blocks of 4 x 4 pixels, with
+    # the colors of 2 of its pattern bytes, which 2 depending on the row
+    def draw_multicolor(self, full):
+        bg_map   = (self.registers[2] & 15) << 10
+        bg_tiles = (self.registers[4] &  7) << 11
+
+        ram = np.frombuffer(self.ram, dtype=np.uint8)
+
+        chars = ram[bg_map:bg_map + 32 * 24]
+
+        which = self.changed_cells(full, bg_map, 32, bg_tiles, chars)
+
+        cells = np.arange(32 * 24) if which is None else which
+
+        if len(cells) == 0:
+            return 0
+
+        offsets = bg_tiles + chars[cells].astype(np.int32) * 8 + (cells // 32 & 3) * 2
+
+        colors = ram[offsets[:, None] + np.arange(2)]
+
+        blocks = self.palette[np.stack((colors >> 4, colors & 15), axis=2)]
+
+        self.put_cells(blocks.repeat(4, axis=1).repeat(4, axis=2), 32, which)
+
+        return len(cells)
+
+    # screen 5 - 8: the page at R#2, scrolled by R#23, redrawn as a whole
+    # when any of it was written to
+    def draw_bitmap(self, vm, full):
+        ppb, bpl = renderer.BITMAP[vm]
+
+        if bpl == 128:
+            page = (self.registers[2] & 0x60) << 10
+
+        else:
+            page = (self.registers[2] & 0x20) << 11
+
+        lines = 212 if self.registers[9] & 128 else 192
+
+        self.width = bpl * ppb
+        self.height = lines
+
+        if not full and not self.dirty_blocks(page, 256 * bpl // 8).any():
+            return 0
+
+        ram = np.frombuffer(self.ram, dtype=np.uint8)
+
+        rows = (np.arange(lines) + self.registers[23]) & 255
+
+        data = ram[page:page + 256 * bpl].reshape(256, bpl)[rows]
+
+        if ppb == 4:
+            pixels = np.stack((data >> 6, (data >> 4) & 3, (data >> 2) & 3, data & 3), axis=2)
+
+        elif ppb == 2:
+            pixels = np.stack((data >> 4, data & 15), axis=2)
+
+        else:
+            pixels = data
+
+        pixels = pixels.reshape(lines, self.width)
+
+        if vm == 25:
+            self.arr[0:self.width, 0:lines] = self.g7_palette[pixels].T
+
+        else:
+            self.arr[0:self.width, 0:lines] = self.palette[pixels].T
+
+        return self.width * lines // 64
+
+    # draws the current snapshot into arr: only the cells that changed
+    # since the previous one, or all of them when full is set or the
+    # registers changed; returns False for an unsupported mode
+    def draw(self, full=False):
+        vm = self.video_mode()
+
+        # the display registers (not the ones for VRAM, status, palette
+        # and register access or the commands)
+        registers = self.registers[0:14] + self.registers[18:24]
+
+        if registers != self.drawn_registers:
+            full = True
+
+        if self.core.msx2 and self.palette_registers != self.drawn_palette:
+            self.set_palette()
+            full = True
+
+        # a changed sprite can uncover any cell
+        has_sprites = vm in (0, 1, 2)
+
+        self.width = 320
+        self.height = 192
+
+        if has_sprites and not full and self.sprites_dirty():
+            full = True
+
+        if vm == 1:  # 'screen 2' (256 x 192)
+            cells = self.draw_screen2(full)
+
+        elif vm == 4:  # 40 x 24
+            cells = self.draw_text(full)
+
+        elif vm == 0:  # 'screen 1' (32 x 24)
+            cells = self.draw_screen1(full)
+
+        elif vm == 2:  # 'screen 3' (64 x 48 blocks)
+            cells = self.draw_multicolor(full)
+
+        elif vm in renderer.BITMAP and self.core.msx2:  # 'screen 5' - 'screen 8'
+            cells = self.draw_bitmap(vm, full)
+
+        else:
+            print('Unsupported resolution')
+            return False
+
+        if has_sprites and cells:
+            self.sprites.update(self.ram, self.registers)
+            self.sprites.draw(self.arr, self.palette)
+
+        self.drawn_registers = registers
+
+        self.cells_drawn = cells
+
+        if cells == 0:
+            self.frames_skipped += 1
+            return True
+
+        self.frames_drawn += 1
+
+        return True
+
+    # the frame as height rows of width pixels of 3 bytes (R, G, B)
+    def rgb_frame(self):
+        pixels = self.arr[0:self.width, 0:self.height].T
+
+        return np.stack((pixels >> 16, pixels >> 8, pixels), axis=2).astype(np.uint8).tobytes()
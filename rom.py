@@ -1,6 +1,7 @@
 # (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
 # released under AGPL v3.0
 
+import mmap
 import sys
 from pagetype import PageType
 
@@ -8,8 +9,9 @@ class rom:
     def __init__(self, rom_file, debug, base_address):
         print('Loading ROM %s...' % rom_file, file=sys.stderr)
 
+        # the pages are only read in when used
         fh = open(rom_file, 'rb')
-        self.rom = [ int(b) for b in fh.read() ]
+        self.rom = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
         fh.close()
 
         self.base_address = base_address
@@ -19,6 +21,17 @@ class rom:
     def get_signature(self):
         return (self.rom, PageType.ROM, self)
 
+    # (data, offset): the page is data[a - offset], if all of it is there
+    def page_buffer(self, page):
+        if page << 14 < self.base_address or (page + 1) << 14 > self.base_address + len(self.rom):
+            return None
+
+        return (self.rom, self.base_address)
+
+    # (data, base, first, last) for z80.block_mem
+    def get_block(self, a):
+        return (self.rom, self.base_address, self.base_address, self.base_address + len(self.rom) - 1)
+
     def write_mem(self, a, v):
         pass
 
@@ -1,6 +1,7 @@
 # (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
 # released under AGPL v3.0
 
+import mmap
 import sys
 from pagetype import PageType
 
@@ -9,13 +10,20 @@ class scc:
         print('Loading SCC rom %s...' % scc_rom_file, file=sys.stderr)
 
         fh = open(scc_rom_file, 'rb')
-        self.scc_rom = [ int(b) for b in fh.read() ]
+        self.scc_rom = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
         fh.close()
 
         self.n_pages = (len(self.scc_rom) + 0x1fff) // 0x2000
 
+        # the 8 KB banks as views on the image
+        rom = memoryview(self.scc_rom)
+        self.banks = [ rom[i * 0x2000:(i + 1) * 0x2000] for i in range(0, self.n_pages) ]
+
         self.scc_pages = [ 0, 1, 2, 3 ]
 
+        # the banks selected at 0x4000, 0x6000, 0x8000 and 0xa000
+        self.windows = [ self.banks[p & (self.n_pages - 1)] for p in self.scc_pages ]
+
         self.snd = snd
 
         self.debug = debug
@@ -32,6 +40,7 @@ class scc:
             and_ = v & (self.n_pages - 1)
             self.debug('Set bank %d to %d/%d (%04x)' % (bank, v, and_, a))
             self.scc_pages[bank] = and_
+            self.windows[bank] = self.banks[and_]
 
         elif a >= 0x9800 and a <= 0xafff0:
             if self.snd:
@@ -41,9 +50,4 @@ class scc:
             self.debug('SCC write to %04x not understood' % a)
 
     def read_mem(self, a):
-        bank = (a >> 13) - 2
-        #print('%04x, SCC bank %d, p: %d' % (a, bank, self.scc_pages[bank]), file=sys.stderr)
-        offset = a & 0x1fff
-        p = self.scc_pages[bank] * 0x2000 + offset
-
-        return self.scc_rom[p]
+        return self.windows[(a >> 13) - 2][a & 0x1fff]
@@ -1,22 +1,38 @@
 # (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
 # released under AGPL v3.0
 
+import mmap
 import os
 import signal
-import struct
 import sys
 import threading
 from vdp import vdp
-
+from vdp_core import vdp_core
+
+# The VDP state (VRAM, registers, status) and the keyboard matrix live in
+# an anonymous shared memory region that is created before the fork. The
+# cpu process handles the VDP ports on it with a vdp_core, the display
+# process only reads VRAM/registers to draw and writes the keyboard
+# matrix. The pipe only carries frame notifications; while the display
+# process has not yet picked up the previous one, further frames are
+# combined with it instead of written.
+#
+# The layout of the region: VRAM (16 or 128 KB), registers, status,
+# palette, the frame pending flag, the keyboard matrix and the dirty map.
+#
+# VRAM writes are marked in the dirty map of the cpu side vdp_core. At a
+# frame it is handed over to the display process through a second (shared)
+# map, but only when the display process has taken the previous one (the
+# same moment the frame notification is sent), so neither side can lose
+# or see half of an update.
 class screen_kb:
-    MSG_SET_IO = 0
-    MSG_GET_IO = 1
-    MSG_INTERRUPT = 2
-    MSG_GET_REG = 3
+    MSG_FRAME = 0
 
-    def __init__(self, io):
+    # msx2: a V9938 instead of a TMS9918
+    def __init__(self, io, msx2=False):
         self.stop_flag = False
         self.io = io
+        self.msx2 = msx2
 
         self.keyboard_queue = []
         self.k_lock = threading.Lock()
@@ -24,97 +40,131 @@ class screen_kb:
         self.debug_msg_lock = threading.Lock()
         self.debug_msg = None
 
+        self.keyboard_row = 0
+
+        # frames signalled and pipe writes needed for them
+        self.n_frames = 0
+        self.n_writes = 0
+
+        self.init_shm()
+
         self.init_screen()
 
         super(screen_kb, self).__init__()
 
-    def init_screen(self):
-        # pipes for data to the VDP
-        self.pipe_tv_in, self.pipe_tv_out = os.pipe()       
+    def init_shm(self):
+        vram_size = vdp_core.VRAM_SIZE_MSX2 if self.msx2 else vdp_core.VRAM_SIZE
 
-        # pipes for data from the VDP
-        self.pipe_fv_in, self.pipe_fv_out = os.pipe()       
+        sizes = ( vram_size, vdp_core.N_REGISTERS, vdp_core.N_STATUS, vdp_core.PALETTE_SIZE, 1, 16, vram_size >> vdp_core.DIRTY_SHIFT )
 
-        self.pid = os.fork()
+        self.shm = mmap.mmap(-1, sum(sizes))
 
-        if self.pid == 0:
-            self.vdp = vdp()
-            self.vdp.start()
-            
-            while True:
-                type_ = os.read(self.pipe_tv_in, 1)[0]
+        view = memoryview(self.shm)
+
+        parts = []
+        offset = 0
+
+        for size in sizes:
+            parts.append(view[offset:offset + size])
+            offset += size
+
+        ram, registers, status, palette, self.frame_pending, self.keyboard, self.dirty = parts
+
+        self.core = vdp_core(ram, registers, status, None, palette, self.msx2)
+        self.core.reset_palette()
+
+        # no keys pressed
+        self.keyboard[0:16] = b'\xff' * 16
+
+    def init_screen(self):
+        # pipe for frame notifications to the display process
+        self.pipe_tv_in, self.pipe_tv_out = os.pipe()
 
-                if type_ == screen_kb.MSG_SET_IO:
-                    data = os.read(self.pipe_tv_in, 2)
-                    a = data[0]
-                    v = data[1]
+        self.pid = os.fork()
 
-                    self.vdp.write_io(a, v)
+        if self.pid == 0:
+            os.close(self.pipe_tv_out)
 
-                elif type_ == screen_kb.MSG_GET_IO:
-                    a = os.read(self.pipe_tv_in, 1)[0]
-                    v = self.vdp.read_io(a)
+            # the display side view on the VDP, with the handed over map
+            core = vdp_core(self.core.ram, self.core.registers, self.core.status, self.dirty, self.core.palette, self.msx2)
 
-                    packet = ( screen_kb.MSG_GET_IO, a, v )
-                    os.write(self.pipe_fv_out, bytearray(packet))
+            self.vdp = vdp(core, self.keyboard, self.frame_taken)
+            self.vdp.start()
 
-                elif type_ == screen_kb.MSG_INTERRUPT:
-                    self.vdp.registers[2] |= 128
+            while True:
+                data = os.read(self.pipe_tv_in, 4096)
 
-                elif type_ == screen_kb.MSG_GET_REG:
-                    a = os.read(self.pipe_tv_in, 1)[0]
+                if not data:
+                    break
 
-                    packet = ( screen_kb.MSG_GET_REG, self.vdp.registers[a] )
-                    os.write(self.pipe_fv_out, bytearray(packet))
+                # several queued frames only need one redraw
+                if data[-1] == screen_kb.MSG_FRAME:
+                    self.vdp.frame()
 
                 else:
-                    print('Unexpected message %d' % type_)
+                    print('Unexpected message %d' % data[-1])
 
             sys.exit(1)
 
         print(self.pid)
 
         os.close(self.pipe_tv_in)
-        os.close(self.pipe_fv_out)
 
+        # never let the cpu wait for a slow display
+        os.set_blocking(self.pipe_tv_out, False)
+
+    # display process: the frame (and the dirty map) has been copied, so
+    # the next one can be handed over
+    def frame_taken(self):
+        self.frame_pending[0] = 0
+
+    # every emulated frame, also when the cpu does not take the interrupt
+    # (DI or IE0 off): the display only redraws on a frame message
     def interrupt(self):
-        os.write(self.pipe_tv_out, screen_kb.MSG_INTERRUPT.to_bytes(1, 'big'))
+        self.core.interrupt()
 
-    def IE0(self):
-        packet = [ screen_kb.MSG_GET_REG, 1 ]  # request VDP status register 1
-        os.write(self.pipe_tv_out, bytearray(packet))
+        self.n_frames += 1
 
-        data = os.read(self.pipe_fv_in, 2)
-        type_ = data[0]
-        assert type_ == screen_kb.MSG_GET_REG
-        v = data[1]
+        if self.frame_pending[0]:
+            return
 
-        return (v & 32) == 32
+        self.frame_pending[0] = 1
 
-    def write_io(self, a, v):
-        packet = ( screen_kb.MSG_SET_IO, a, v )
-        os.write(self.pipe_tv_out, bytearray(packet))
+        self.dirty[:] = self.core.dirty
+        self.core.dirty[:] = bytes(len(self.dirty))
 
-    def read_io(self, a):
-        if a in (0x98, 0x99, 0xa9):
+        try:
+            os.write(self.pipe_tv_out, screen_kb.MSG_FRAME.to_bytes(1, 'big'))
+            self.n_writes += 1
 
-            packet = ( screen_kb.MSG_GET_IO, a )
-            os.write(self.pipe_tv_out, bytearray(packet))
+        except BlockingIOError:
+            self.core.dirty[:] = self.dirty
+            self.frame_pending[0] = 0
 
-            data = os.read(self.pipe_fv_in, 3)
-            type_ = data[0]
-            assert type_ == screen_kb.MSG_GET_IO
+    # frame messages per pipe write since the previous call
+    def messages_per_syscall(self):
+        rc = self.n_frames / self.n_writes if self.n_writes else 0.0
 
-            a_ = data[1]
-            assert a_ == a
+        self.n_frames = self.n_writes = 0
 
-            v = data[2]
+        return rc
 
-            return v
+    def IE0(self):
+        return self.core.IE0()
 
-        print('unexpected port %02x' % a)
+    # 0x98/0x99 can also go to self.core directly
+    def write_io(self, a, v):
+        if a == 0xaa:  # PPI register C
+            self.keyboard_row = v & 15
+
+        else:
+            self.core.write_io(a, v)
+
+    def read_io(self, a):
+        if a == 0xa9:
+            return self.keyboard[self.keyboard_row]
 
-        return 0x00
+        return self.core.read_io(a)
 
     def debug(self, str_):
         self.debug_msg_lock.acquire()
@@ -127,4 +177,3 @@ class screen_kb:
         os.wait()
 
         os.close(self.pipe_tv_out)
-        os.close(self.pipe_fv_in)
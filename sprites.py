@@ -0,0 +1,110 @@
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+import numpy as np
+
+# TMS9918 sprites: which of them are shown on which line (at most 4 per
+# line), the 5th sprite and collision status bits, and a layer with their
+# pixels to draw over the background. Everything is only computed again
+# when the attribute table, the sprite pattern table or the size and
+# magnification bits change.
+class sprites:
+    def __init__(self):
+        self.key = None
+
+        # status register bits: 5th sprite flag (64), collision (32) and the
+        # number of the 5th (or last) sprite
+        self.status = 0
+
+        # per pixel (x, y): the color of the sprite shown there, 0 for none
+        self.layer = np.zeros((256, 192), dtype=np.uint8)
+
+    def update(self, ram, registers):
+        attr = (registers[5] & 127) << 7
+        patt = (registers[6] & 7) << 11
+
+        attributes = bytes(ram[attr:attr + 128])
+        patterns = bytes(ram[patt:patt + 2048])
+
+        key = (registers[1] & 3, attributes, patterns)
+        if key == self.key:
+            return
+
+        self.key = key
+
+        a = np.frombuffer(attributes, dtype=np.uint8).reshape(32, 4).astype(np.int32)
+
+        # y = 208 ends the table
+        end = np.flatnonzero(a[:, 0] == 208)
+        n = end[0] if len(end) else 32
+
+        a = a[:n]
+
+        size = 16 if registers[1] & 2 else 8
+        mag = 2 if registers[1] & 1 else 1
+        extent = size * mag
+
+        # the first line is y + 1, from 209 on y is negative; the early
+        # clock bit moves a sprite 32 pixels to the left
+        y = np.where(a[:, 0] > 208, a[:, 0] - 256, a[:, 0]) + 1
+        x = a[:, 1] - np.where(a[:, 3] & 128, 32, 0)
+        colors = a[:, 3] & 15
+
+        # (n, size, size) masks: sprite, row, column; a 16x16 sprite is 4
+        # 8x8 patterns, the right half 16 bytes after the left
+        p = np.frombuffer(patterns, dtype=np.uint8)
+
+        rows = (a[:, 2] & (0xfc if size == 16 else 0xff))[:, None] * 8 + np.arange(size)
+
+        masks = np.unpackbits(p[rows][:, :, None], axis=2)
+
+        if size == 16:
+            masks = np.concatenate((masks, np.unpackbits(p[rows + 16][:, :, None], axis=2)), axis=2)
+
+        if mag == 2:
+            masks = masks.repeat(2, axis=1).repeat(2, axis=2)
+
+        # (n, 192): lines on which a sprite is, shown on the first 4 only
+        lines = np.arange(192)
+        covers = (lines >= y[:, None]) & (lines < y[:, None] + extent)
+        rank = np.cumsum(covers, axis=0)
+        shown = covers & (rank <= 4)
+
+        self.status = min(n, 31)
+
+        if n:
+            over = np.flatnonzero(rank[-1] > 4)
+
+            if len(over):
+                self.status = 64 | int(np.argmax(rank[:, over[0]] == 5))
+
+        # lowest sprite number has priority: draw them last
+        self.layer[:] = 0
+
+        count = np.zeros((256, 192), dtype=np.uint8)
+
+        for i in range(n - 1, -1, -1):
+            x0 = max(x[i], 0)
+            x1 = min(x[i] + extent, 256)
+            y0 = max(y[i], 0)
+            y1 = min(y[i] + extent, 192)
+
+            if x0 >= x1 or y0 >= y1:
+                continue
+
+            # (x, y) mask of the part on the screen
+            mask = (masks[i, y0 - y[i]:y1 - y[i], x0 - x[i]:x1 - x[i]] & shown[i, y0:y1, None]).T.astype(bool)
+
+            count[x0:x1, y0:y1] += mask
+
+            if colors[i]:
+                self.layer[x0:x1, y0:y1][mask] = colors[i]
+
+        if (count > 1).any():
+            self.status |= 32
+
+    # arr is (x, y) with at least 256 x 192 pixels
+    def draw(self, arr, palette):
+        shown = self.layer != 0
+
+        arr[0:256, 0:192][shown] = palette[self.layer[shown]]
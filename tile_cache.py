@@ -0,0 +1,36 @@
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+from collections import OrderedDict
+
+# Least recently used cache of drawn 8x8 tiles, keyed by their contents
+# (e.g. the 8 pattern and 8 colour bytes). Holds at most size tiles.
+class tile_cache:
+    def __init__(self, size=4096):
+        self.size = size
+
+        self.tiles = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        tile = self.tiles.get(key)
+
+        if tile is None:
+            self.misses += 1
+            return None
+
+        self.tiles.move_to_end(key)
+        self.hits += 1
+
+        return tile
+
+    def put(self, key, tile):
+        self.tiles[key] = tile
+
+        if len(self.tiles) > self.size:
+            self.tiles.popitem(last=False)
+
+    def clear(self):
+        self.tiles.clear()
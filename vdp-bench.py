@@ -0,0 +1,97 @@
+#! /usr/bin/python3
+
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+# measures how many frames per second the renderer can draw, per video
+# mode, from VRAM filled with random data (no window needed). Every frame
+# is drawn completely, unless -w is given: then that many random VRAM bytes
+# are written per frame and only the changed cells are drawn.
+
+import random
+import time
+from optparse import OptionParser
+from renderer import renderer
+from vdp_core import vdp_core
+
+parser = OptionParser()
+parser.add_option('-s', '--seconds', dest='seconds', type='float', default=2.0, help='how long to draw each mode')
+parser.add_option('-m', '--mode', dest='modes', action='append', help='mode to measure: screen0 - screen3 or (V9938) screen5 - screen8 (default: all)')
+parser.add_option('-p', '--sprites', dest='sprites', type='int', default=0, help='number of (random) sprites in screen 1 - 3')
+parser.add_option('-w', '--writes', dest='writes', type='int', help='write this many random bytes to VRAM per frame and only draw what changed')
+(options, args) = parser.parse_args()
+
+# VDP registers per mode; the tables are at the usual BIOS addresses, the
+# bitmap modes show page 0 with 212 lines
+modes = {
+        'screen0' : ( 0x00, 0x10, 0x00, 0x00, 0x01, 0x00, 0x00, 0xf4 ),
+        'screen1' : ( 0x00, 0x00, 0x06, 0x80, 0x00, 0x36, 0x07, 0x04 ),
+        'screen2' : ( 0x02, 0x00, 0x06, 0xff, 0x03, 0x36, 0x07, 0x04 ),
+        'screen3' : ( 0x00, 0x08, 0x02, 0x00, 0x00, 0x36, 0x07, 0x04 ),
+        'screen5' : ( 0x06, 0x00, 0x1f, 0x00, 0x00, 0xef, 0x0f, 0x04, 0x08, 0x80 ),
+        'screen6' : ( 0x08, 0x00, 0x1f, 0x00, 0x00, 0xef, 0x0f, 0x04, 0x08, 0x80 ),
+        'screen7' : ( 0x0a, 0x00, 0x1f, 0x00, 0x00, 0xf7, 0x1e, 0x04, 0x08, 0x80 ),
+        'screen8' : ( 0x0e, 0x00, 0x1f, 0x00, 0x00, 0xf7, 0x1e, 0x04, 0x08, 0x80 ),
+        }
+
+random.seed(1)
+
+for mode in options.modes or sorted(modes):
+    # screen 5 - 8 need a V9938
+    msx2 = mode > 'screen3'
+
+    core = vdp_core(msx2=msx2)
+
+    v = renderer(core)
+
+    core.registers[0:len(modes[mode])] = bytes(modes[mode])
+
+    # two VRAM images that the full redraws alternate between: with the
+    # same tables every frame, screen 2 would find its tiles unchanged
+    images = []
+
+    while len(images) < 2:
+        core.ram[:] = bytes(random.randrange(256) for i in range(len(core.ram)))
+
+        # y = 208 ends the sprite attribute table
+        if options.sprites < 32:
+            core.ram[((core.registers[5] & 127) << 7) + options.sprites * 4] = 208
+
+        images.append(bytes(core.ram))
+
+    v.snapshot()
+
+    v.draw(True)
+
+    n = cells = 0
+    start = time.time()
+
+    while time.time() - start < options.seconds:
+        if options.writes == None:
+            # and without the tiles drawn from them in the cache
+            v.ram = images[n & 1]
+            v.tile_cache.clear()
+
+            v.draw(True)
+
+        else:
+            for i in range(options.writes):
+                a = random.randrange(len(core.ram))
+
+                if msx2:
+                    core.write_io(0x99, a >> 14)
+                    core.write_io(0x99, 0x80 | 14)
+
+                core.write_io(0x99, a & 255)
+                core.write_io(0x99, 0x40 | ((a >> 8) & 63))
+                core.write_io(0x98, random.randrange(256))
+
+            v.snapshot()
+            v.draw()
+
+        n += 1
+        cells += v.cells_drawn
+
+    took = time.time() - start
+
+    print('%s: %d frames in %.2f seconds: %.1f frames/s, %.1f cells drawn per frame' % (mode, n, took, n / took, cells / n))
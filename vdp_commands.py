@@ -0,0 +1,316 @@
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+import numpy as np
+
+# V9938 command engine. A command (written to R#46) works on the bitmap of
+# the current mode (screen 5 - 8) in VRAM coordinates: x up to 255 or 511,
+# y up to the end of the VRAM. Commands run at once, as array operations
+# on the whole rectangle (or line); only HMMC, LMMC and LMCM go a byte at a
+# time, as the cpu transfers their data through R#44 and S#7.
+class vdp_commands:
+    # R#0 mode bits (M5, M4, M3) -> pixels per byte, bytes per line;
+    # the other modes are addressed like screen 8
+    GEOMETRY = { 0x06: (2, 128), 0x08: (4, 128), 0x0a: (2, 256), 0x0e: (1, 256) }
+
+    # commands (R#46 bits 4 - 7)
+    STOP = 0
+    POINT = 4
+    PSET = 5
+    SRCH = 6
+    LINE = 7
+    LMMV = 8
+    LMMM = 9
+    LMCM = 10
+    LMMC = 11
+    HMMV = 12
+    HMMM = 13
+    YMMM = 14
+    HMMC = 15
+
+    def __init__(self, core):
+        self.core = core
+
+        self.vram = np.frombuffer(core.ram, dtype=np.uint8)
+        self.dirty = np.frombuffer(core.dirty, dtype=np.uint8)
+
+        # S#2 command execute and border detected bits
+        self.ce = 0
+        self.bd = 0
+
+        # HMMC/LMMC/LMCM: the VRAM addresses (and bit positions) still to
+        # be transferred, the next one at self.pos
+        self.cmd = None
+        self.addrs = None
+        self.shifts = None
+        self.colors = None
+        self.pos = 0
+
+    def geometry(self):
+        self.ppb, self.bpl = vdp_commands.GEOMETRY.get(self.core.registers[0] & 0x0e, (1, 256))
+
+        self.width = self.bpl * self.ppb
+        self.lines = len(self.vram) // self.bpl
+        self.bits = 8 // self.ppb
+        self.mask = (1 << self.bits) - 1
+
+    def status2(self):
+        # TR is always set: transfers never have to wait
+        return 0x8c | (self.bd << 4) | self.ce
+
+    # n coordinates from x in the direction of dix, up to the edge
+    def xs(self, x, n, dix, width):
+        n = min(n, x + 1 if dix else width - x)
+
+        return x - np.arange(n) if dix else x + np.arange(n)
+
+    def ys(self, y, n, diy):
+        return (y - np.arange(n) if diy else y + np.arange(n)) & (self.lines - 1)
+
+    # VRAM address and bit position of the pixels at x, y (arrays that
+    # broadcast)
+    def locate(self, x, y):
+        addr = y * self.bpl + x // self.ppb
+        shift = (self.ppb - 1 - x % self.ppb) * self.bits
+
+        return np.broadcast_arrays(addr, shift)
+
+    def get_pixels(self, addr, shift):
+        return (self.vram[addr] >> shift) & self.mask
+
+    def put_pixels(self, addr, shift, values, write):
+        # a byte has one pixel per bit position, so per position all
+        # addresses differ
+        for s in range(0, 8, self.bits):
+            sel = write & (shift == s)
+
+            a = addr[sel]
+
+            self.vram[a] = (self.vram[a] & (0xff ^ (self.mask << s))) | (values[sel] << s)
+
+        self.dirty[addr[write] >> 3] = 1
+
+    def put_bytes(self, addr, values):
+        self.vram[addr] = values
+        self.dirty[addr >> 3] = 1
+
+    # logical operation op (R#46 bits 0 - 3) of src on dst: the new values
+    # and where to write them (the T variants skip color 0)
+    def logical(self, op, src, dst):
+        src = np.broadcast_to(np.asarray(src, dtype=np.uint8) & self.mask, dst.shape)
+
+        base = op & 7
+
+        if base == 0:  # IMP
+            values = src
+
+        elif base == 1:  # AND
+            values = src & dst
+
+        elif base == 2:  # OR
+            values = src | dst
+
+        elif base == 3:  # EOR
+            values = src ^ dst
+
+        elif base == 4:  # NOT
+            values = ~src & self.mask
+
+        else:
+            values = dst
+
+        if op & 8:
+            write = src != 0
+
+        else:
+            write = np.ones(dst.shape, dtype=bool)
+
+        return values.astype(np.uint8), write
+
+    def apply(self, op, src, addr, shift):
+        values, write = self.logical(op, src, self.get_pixels(addr, shift))
+
+        self.put_pixels(addr, shift, values, write)
+
+    # R#46 has been written to
+    def start(self):
+        self.geometry()
+
+        r = self.core.registers
+
+        sx = r[32] | ((r[33] & 1) << 8)
+        sy = r[34] | ((r[35] & 3) << 8)
+        dx = r[36] | ((r[37] & 1) << 8)
+        dy = r[38] | ((r[39] & 3) << 8)
+        nx = (r[40] | ((r[41] & 1) << 8)) or 512
+        ny = (r[42] | ((r[43] & 3) << 8)) or 1024
+        clr = r[44]
+        arg = r[45]
+        cmd = r[46] >> 4
+        op = r[46] & 15
+
+        dix = arg & 4
+        diy = arg & 8
+
+        sx %= self.width
+        dx %= self.width
+
+        self.cmd = None
+        self.ce = 0
+
+        if cmd == vdp_commands.POINT:
+            addr, shift = self.locate(sx, sy & (self.lines - 1))
+
+            self.core.status[7] = int(self.get_pixels(addr, shift))
+
+        elif cmd == vdp_commands.PSET:
+            self.apply(op, clr, *self.locate(dx, dy & (self.lines - 1)))
+
+        elif cmd == vdp_commands.SRCH:
+            x = self.xs(sx, self.width, dix, self.width)
+
+            values = self.get_pixels(*self.locate(x, sy & (self.lines - 1)))
+
+            # EQ (arg bit 1) searches for a color other than clr
+            found = np.flatnonzero((values == (clr & self.mask)) != bool(arg & 2))
+
+            self.bd = 1 if len(found) else 0
+
+            if self.bd:
+                self.core.status[8] = int(x[found[0]]) & 0xff
+                self.core.status[9] = (int(x[found[0]]) >> 8) | 0xfe
+
+        elif cmd == vdp_commands.LINE:
+            self.line(dx, dy, nx & 511, ny & 1023, arg, clr, op)
+
+        elif cmd in (vdp_commands.LMMV, vdp_commands.LMMC):
+            addr, shift = self.locate(self.xs(dx, nx, dix, self.width)[None, :], self.ys(dy, ny, diy)[:, None])
+
+            if cmd == vdp_commands.LMMV:
+                self.apply(op, clr, addr, shift)
+
+            else:
+                self.stream(cmd, addr.ravel(), shift.ravel())
+                self.transfer(clr)
+
+        elif cmd == vdp_commands.LMMM:
+            n = min(nx, sx + 1 if dix else self.width - sx)
+
+            src = self.locate(self.xs(sx, n, dix, self.width)[None, :], self.ys(sy, ny, diy)[:, None])
+            dst = self.locate(self.xs(dx, n, dix, self.width)[None, :], self.ys(dy, ny, diy)[:, None])
+
+            n = dst[0].shape[1]
+
+            self.apply(op, self.get_pixels(src[0][:, :n], src[1][:, :n]), *dst)
+
+        elif cmd == vdp_commands.LMCM:
+            addr, shift = self.locate(self.xs(sx, nx, dix, self.width)[None, :], self.ys(sy, ny, diy)[:, None])
+
+            self.stream(cmd, addr.ravel(), shift.ravel())
+            self.colors = self.get_pixels(self.addrs, self.shifts)
+
+            self.core.status[7] = int(self.colors[0])
+
+        elif cmd in (vdp_commands.HMMV, vdp_commands.HMMC):
+            addr = self.byte_rect(dx, dy, nx, ny, dix, diy)
+
+            if cmd == vdp_commands.HMMV:
+                self.put_bytes(addr, clr)
+
+            else:
+                self.stream(cmd, addr.ravel())
+                self.transfer(clr)
+
+        elif cmd == vdp_commands.HMMM:
+            n = max(nx // self.ppb, 1)
+            n = min(n, sx // self.ppb + 1 if dix else self.bpl - sx // self.ppb)
+
+            src = self.byte_rect(sx, sy, n * self.ppb, ny, dix, diy)
+            dst = self.byte_rect(dx, dy, n * self.ppb, ny, dix, diy)
+
+            self.put_bytes(dst, self.vram[src[:, :dst.shape[1]]])
+
+        elif cmd == vdp_commands.YMMM:
+            # from dx to the edge, from line sy to dy
+            src = self.byte_rect(dx, sy, self.width, ny, dix, diy)
+            dst = self.byte_rect(dx, dy, self.width, ny, dix, diy)
+
+            self.put_bytes(dst, self.vram[src])
+
+    # (ny, n) VRAM addresses of the bytes with the pixels x, y - nx, ny
+    def byte_rect(self, x, y, nx, ny, dix, diy):
+        xb = self.xs(x // self.ppb, max(nx // self.ppb, 1), dix, self.bpl)
+
+        return self.ys(y, ny, diy)[:, None] * self.bpl + xb[None, :]
+
+    def line(self, dx, dy, nx, ny, arg, clr, op):
+        # nx + 1 pixels along the major axis, a step along the minor one
+        # each time the error term (starting at (nx - 1) / 2) goes below 0
+        i = np.arange(nx + 1)
+
+        if nx:
+            minor = np.minimum(np.maximum(0, -((((nx - 1) >> 1) - i * ny) // nx)), i)
+
+        else:
+            minor = i
+
+        tx = -1 if arg & 4 else 1
+        ty = -1 if arg & 8 else 1
+
+        if arg & 1:  # MAJ: y is the long side
+            x = dx + tx * minor
+            y = dy + ty * i
+
+        else:
+            x = dx + tx * i
+            y = dy + ty * minor
+
+        # the line ends at the left or right edge
+        out = np.flatnonzero((x < 0) | (x >= self.width))
+
+        if len(out):
+            x = x[:out[0]]
+            y = y[:out[0]]
+
+        self.apply(op, clr, *self.locate(x, y & (self.lines - 1)))
+
+    def stream(self, cmd, addrs, shifts=None):
+        self.cmd = cmd
+        self.addrs = addrs
+        self.shifts = shifts
+        self.pos = 0
+        self.ce = 1 if len(addrs) else 0
+
+    # HMMC/LMMC: a byte from the cpu through R#44
+    def transfer(self, v):
+        if not self.ce or self.cmd == vdp_commands.LMCM:
+            return
+
+        a = self.addrs[self.pos:self.pos + 1]
+
+        if self.cmd == vdp_commands.HMMC:
+            self.put_bytes(a, v)
+
+        else:
+            self.apply(self.core.registers[46] & 15, v, a, self.shifts[self.pos:self.pos + 1])
+
+        self.next()
+
+    # LMCM: S#7 is read
+    def read_color(self):
+        rc = self.core.status[7]
+
+        if self.ce and self.cmd == vdp_commands.LMCM:
+            self.next()
+
+            if self.ce:
+                self.core.status[7] = int(self.colors[self.pos])
+
+        return rc
+
+    def next(self):
+        self.pos += 1
+
+        if self.pos >= len(self.addrs):
+            self.ce = 0
+            self.cmd = None
@@ -0,0 +1,218 @@
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+from sprites import sprites
+from vdp_commands import vdp_commands
+
+# TMS9918 (or, with msx2, V9938) state: VRAM, registers, status, palette
+# and the port (0x98 - 0x9b) logic.
+# No pygame here: the cpu thread calls write_io/read_io directly, a
+# renderer reads ram/registers (see vdp.py).
+class vdp_core:
+    VRAM_SIZE = 16384
+    VRAM_SIZE_MSX2 = 131072
+
+    # registers 0 - 46 (only 0 - 7 on a TMS9918), status registers 0 - 9
+    # and the palette: 16 times 0RRR0BBB, 00000GGG
+    N_REGISTERS = 64
+    N_STATUS = 16
+    PALETTE_SIZE = 32
+
+    # writes to VRAM are tracked in blocks of 8 bytes (one pattern, 8 name
+    # table entries or 2 sprite attributes): dirty[a >> DIRTY_SHIFT] is set
+    # to 1 and reset by whoever draws the VRAM
+    DIRTY_SHIFT = 3
+
+    # V9938 palette after a reset, (R, G, B) 0 - 7
+    PALETTE = ( (0, 0, 0), (0, 0, 0), (1, 6, 1), (3, 7, 3), (1, 1, 7), (2, 3, 7), (5, 1, 1), (2, 6, 7), (7, 1, 1), (7, 3, 3), (6, 6, 1), (6, 6, 4), (1, 4, 1), (6, 2, 5), (5, 5, 5), (7, 7, 7) )
+
+    # ram (16 or 128 KB), registers, status, palette and dirty can be given
+    # as buffers, e.g. in shared memory; by default they are bytearrays
+    # (with all of the VRAM dirty)
+    def __init__(self, ram=None, registers=None, status=None, dirty=None, palette=None, msx2=False):
+        self.msx2 = msx2
+
+        vram_size = vdp_core.VRAM_SIZE_MSX2 if msx2 else vdp_core.VRAM_SIZE
+
+        self.ram = ram if ram is not None else bytearray(vram_size)
+        self.registers = registers if registers is not None else bytearray(vdp_core.N_REGISTERS)
+        self.status = status if status is not None else bytearray(vdp_core.N_STATUS)
+        self.dirty = dirty if dirty is not None else bytearray(b'\x01' * (vram_size >> vdp_core.DIRTY_SHIFT))
+
+        if palette is None:
+            self.palette = bytearray(vdp_core.PALETTE_SIZE)
+            self.reset_palette()
+
+        else:
+            self.palette = palette
+
+        self.address_mask = vram_size - 1
+        self.register_mask = 63 if msx2 else 7
+
+        self.vdp_rw_pointer = 0
+        self.vdp_addr_state = False
+        self.vdp_addr_b1 = None
+        self.vdp_read_ahead = 0
+
+        # first byte of a palette entry written to 0x9a
+        self.palette_b1 = None
+
+        self.sprites = sprites()
+
+        self.commands = vdp_commands(self) if msx2 else None
+
+    def reset_palette(self):
+        for i, (r, g, b) in enumerate(vdp_core.PALETTE):
+            self.palette[i * 2:i * 2 + 2] = bytes(((r << 4) | b, g))
+
+    # once per frame, also when the cpu does not take the interrupt (so
+    # that software polling the status with interrupts off sees the bits):
+    # sets the interrupt flag and the sprite status bits
+    def interrupt(self):
+        status = self.status[0] | 128
+
+        # sprites are evaluated when the display is on and not in text or
+        # a bitmap mode
+        if self.registers[1] & 0x50 == 0x40 and not self.registers[0] & 0x0c:
+            self.sprites.update(self.ram, self.registers)
+
+            status |= self.sprites.status & 32
+
+            # the 5th sprite number is kept until the status is read
+            if not status & 64:
+                status = (status & 0xe0) | (self.sprites.status & 0x5f)
+
+        self.status[0] = status
+
+    def IE0(self):
+        return (self.registers[1] & 32) == 32
+
+    def set_register(self, a, v):
+        if a > 46:
+            return
+
+        self.registers[a] = v
+
+        if not self.msx2:
+            return
+
+        if a == 44:  # color, also the data of HMMC/LMMC
+            self.commands.transfer(v)
+
+        elif a == 46:
+            self.commands.start()
+
+        elif a == 16:
+            self.palette_b1 = None
+
+    # next VRAM address on a V9938: R#14 has the upper 3 bits, which only
+    # count on in its own (M4/M5) modes, in the others the address wraps
+    # within 16 KB
+    def next_address(self):
+        if self.registers[0] & 0x0c:
+            self.vdp_rw_pointer = (self.vdp_rw_pointer + 1) & self.address_mask
+
+            if not self.vdp_rw_pointer & 0x3fff:
+                self.registers[14] = self.vdp_rw_pointer >> 14
+
+        else:
+            self.vdp_rw_pointer = (self.vdp_rw_pointer & ~0x3fff) | ((self.vdp_rw_pointer + 1) & 0x3fff)
+
+    def write_io(self, a, v):
+        if a == 0x98:
+            self.ram[self.vdp_rw_pointer] = v
+            self.dirty[self.vdp_rw_pointer >> 3] = 1
+
+            if self.msx2:
+                self.next_address()
+
+            else:
+                self.vdp_rw_pointer = (self.vdp_rw_pointer + 1) & 0x3fff
+
+            self.vdp_addr_state = False
+            self.vdp_read_ahead = v
+
+        elif a == 0x99:
+            if self.vdp_addr_state == False:
+                self.vdp_addr_b1 = v
+
+            else:
+                if (v & 128) == 128:
+                    self.set_register(v & self.register_mask, self.vdp_addr_b1)
+
+                else:
+                    self.vdp_rw_pointer = ((v & 63) << 8) + self.vdp_addr_b1
+
+                    if self.msx2:
+                        self.vdp_rw_pointer |= (self.registers[14] & 7) << 14
+
+                    if (v & 64) == 0:
+                        self.vdp_read_ahead = self.ram[self.vdp_rw_pointer]
+
+                        if self.msx2:
+                            self.next_address()
+
+                        else:
+                            self.vdp_rw_pointer = (self.vdp_rw_pointer + 1) & 0x3fff
+
+            self.vdp_addr_state = not self.vdp_addr_state
+
+        elif a == 0x9a and self.msx2:
+            if self.palette_b1 is None:
+                self.palette_b1 = v
+
+            else:
+                i = (self.registers[16] & 15) * 2
+
+                self.palette[i] = self.palette_b1 & 0x77
+                self.palette[i + 1] = v & 7
+
+                self.registers[16] = (self.registers[16] + 1) & 15
+                self.palette_b1 = None
+
+        elif a == 0x9b and self.msx2:
+            # indirect register write, R#17 increments unless bit 7 is set
+            r17 = self.registers[17]
+
+            self.set_register(r17 & 63, v)
+
+            if not r17 & 128:
+                self.registers[17] = (r17 + 1) & 63
+
+        else:
+            print('vdp_core::write_io: Unexpected port %02x' % a)
+
+    def read_io(self, a):
+        if a == 0x98:
+            rc = self.vdp_read_ahead
+            self.vdp_read_ahead = self.ram[self.vdp_rw_pointer]
+
+            if self.msx2:
+                self.next_address()
+
+            else:
+                self.vdp_rw_pointer = (self.vdp_rw_pointer + 1) & 0x3fff
+
+            return rc
+
+        if a == 0x99:
+            s = self.registers[15] & 15 if self.msx2 else 0
+
+            if s == 0:
+                # reading the status resets the interrupt, 5th sprite and
+                # collision flags
+                rc = self.status[0]
+                self.status[0] = rc & 0x1f
+                return rc
+
+            if s == 2:
+                return self.commands.status2()
+
+            if s == 7:
+                return self.commands.read_color()
+
+            return self.status[s]
+
+        print('vdp_core::read_io: Unexpected port %02x' % a)
+
+        return 0
@@ -1,16 +1,146 @@
 # (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
 # released under AGPL v3.0
 
+import ast
+import inspect
+import json
 import time
+from array import array
+from z80_specialize import decode_tables, strip_trace, translate_block
+
+# flag lookup tables, built once at import
+
+def build_sz53p_table():
+    table = bytearray(256)
+
+    for v in range(0, 256):
+        f = v & 0xa8  # S, 5 and 3
+
+        if v == 0:
+            f |= 0x40
+
+        if (bin(v).count('1') & 1) == 0:
+            f |= 0x04
+
+        table[v] = f
+
+    return bytes(table)
+
+# indexed by (carry << 16) | (a << 8) | value
+def build_add_sub_table(is_sub):
+    table = bytearray(2 * 256 * 256)
+    i = 0
+
+    for c in (0, 1):
+        for a in range(0, 256):
+            a_low = a & 0x0f
+            a_sign = a & 0x80
+
+            for value in range(0, 256):
+                if is_sub:
+                    result = a - value - c
+                    f = 0x12 if ((a_low - (value & 0x0f)) & 0x10) else 0x02
+                    overflow = a_sign != value & 0x80
+
+                else:
+                    result = a + value + c
+                    f = 0x10 if ((a_low + (value & 0x0f)) & 0x10) else 0x00
+                    overflow = a_sign == value & 0x80
+
+                if overflow and (result & 0x80) != a_sign:
+                    f |= 0x04
+
+                result &= 0x1ff
+                f |= (result >> 8) | (result & 0xa8)
+
+                if (result & 0xff) == 0:
+                    f |= 0x40
+
+                table[i] = f
+                i += 1
+
+    return bytes(table)
+
+# indexed by the value before the increment/decrement, without carry
+def build_inc_dec_table(is_dec):
+    table = bytearray(256)
+
+    for before in range(0, 256):
+        after = (before + (-1 if is_dec else 1)) & 0xff
+
+        f = after & 0xa8
+
+        if after == 0:
+            f |= 0x40
+
+        if is_dec:
+            f |= 0x02
+            f |= 0x10 if (after & 0x0f) == 0x0f else 0
+            f |= 0x04 if before == 0x80 else 0
+
+        else:
+            f |= 0x10 if (after & 0x0f) == 0 else 0
+            f |= 0x04 if before == 0x7f else 0
+
+        table[before] = f
+
+    return bytes(table)
+
+FLAGS_SZ53P = build_sz53p_table()
+FLAGS_ADD = build_add_sub_table(False)
+FLAGS_SUB = build_add_sub_table(True)
+FLAGS_INC = build_inc_dec_table(False)
+FLAGS_DEC = build_inc_dec_table(True)
+
+# code that has been overwritten this often is no longer translated
+JIT_VOLATILE = 2
 
 class z80:
-    def __init__(self, read_mem, write_mem, read_io, write_io, debug, screen):
+    # attribute access through slots is faster than through __dict__. The
+    # variants (z80_lazy_flags, ...) are combined by multiple inheritance,
+    # where only one base may add slots, so their attributes are here too
+    __slots__ = ( 'a', 'b', 'c', 'd', 'e', 'f', 'h', 'l', 'a_', 'b_', 'c_', 'd_', 'e_', 'f_', 'h_',
+        'l_', 'ix', 'iy', 'sp', 'pc', 'i', 'r', 'im', 'iff1', 'iff2', 'interrupts', 'int', 'memptr',
+        'cycles', 'interrupt_cycles', 'read_mem', 'write_mem', 'read_io', 'write_io', 'debug_out',
+        'screen', 'trace', 'lazy_flags', 'decoded', 'jit', 'profile', 'main_jumps',
+        'bits_jumps', 'ed_jumps', 'ixy_jumps', 'ixy_bit_jumps', 'ix_jumps', 'iy_jumps',
+        'ix_bit_jumps', 'iy_bit_jumps', 'parity_lookup', 'mapping', 'jit_tables', 'jit_blocks',
+        'jit_block_code', 'jit_users', 'jit_invalidations', 'jit_stop_pcs', 'jit_dirty', 'block_mem',
+        'block_budget', 'block_stop_pcs', 'interrupt_interval', 'jit_aliased',
+        # z80_lazy_flags
+        'lazy', '_f',
+        # z80_profile
+        'profile_opcodes', 'profile_prefixed', 'profile_pc_counts', 'profile_pc_cycles', 'profile_tables' )
+
+    def __new__(cls, *args, trace=True, lazy_flags=False, profile=False, **kwargs):
+        if cls is z80:
+            cls = get_variant_class(trace, lazy_flags, profile)
+
+        return super(z80, cls).__new__(cls)
+
+    def __init__(self, read_mem, write_mem, read_io, write_io, debug, screen, trace=True, lazy_flags=False, decoded=False, jit=False, profile=False, block_mem=None):
         self.read_mem = read_mem
         self.write_mem = write_mem
         self.read_io = read_io
         self.write_io = write_io
         self.debug_out = debug
         self.screen = screen
+        self.trace = trace
+        self.lazy_flags = lazy_flags
+        self.decoded = decoded
+        self.jit = jit
+        self.profile = profile
+
+        # optional: block_mem(a, write) returns (data, base, first, last)
+        # when the addresses first...last (which include a) are plain
+        # memory at data[address - base], else None. Lets LDIR, LDDR, CPIR
+        # and CPDR in run() work on the data directly.
+        self.block_mem = block_mem
+
+        # cycles per video frame (50 Hz); the VDP interrupt is raised once
+        # per frame. An integer, so that a run() of exactly one frame ends
+        # on it (see pacer.frame_cycles)
+        self.interrupt_interval = 3579545 // 50
 
         self.init_main()
         self.init_xy()
@@ -19,13 +149,132 @@ class z80:
         self.init_parity()
         self.init_ext()
 
+        if profile:
+            self.init_profile()
+
+        if jit:
+            self.init_jit()
+
+        if decoded:
+            self.init_decoded()
+
         self.reset()
 
+    # Replaces the jump tables by tables with a generated handler per
+    # opcode (see z80_specialize.py). The DD/FD handlers no longer get
+    # the IX/IY selection as a parameter, there's a table for each.
+    def init_decoded(self):
+        tables = decode_tables(self)
+
+        self.main_jumps = tables['main']
+        self.bits_jumps = tables['bits']
+        self.ed_jumps = tables['ed']
+        self.ix_jumps = tables['ix']
+        self.iy_jumps = tables['iy']
+        self.ix_bit_jumps = tables['ix_bit']
+        self.iy_bit_jumps = tables['iy_bit']
+
+    # Sets up the translation of basic blocks to python functions (see
+    # run_jit()). Blocks are cached by program counter and by
+    # self.mapping; the owner of the memory must give that a different
+    # value for each slot/bank layout and call invalidate_jit() when memory
+    # changes in any other way than through write_mem (e.g. a memory mapper
+    # segment that was written through another page). Code in the pages
+    # set in self.jit_aliased (memory that can also be written through
+    # another page) is not translated.
+    def init_jit(self):
+        # the translator works on the generic handlers
+        self.jit_tables = { 'main': self.main_jumps, 'bits': self.bits_jumps, 'ed': self.ed_jumps, 'ixy': self.ixy_jumps, 'ixy_bit': self.ixy_bit_jumps }
+
+        self.mapping = 0
+        self.jit_blocks = { }
+        self.jit_block_code = { }
+        self.jit_users = [ None ] * 65536  # per address the blocks using it
+        self.jit_invalidations = bytearray(65536)
+        self.jit_stop_pcs = set()
+        self.jit_dirty = False
+        self.jit_aliased = bytes(4)
+
+        host_write_mem = self.write_mem
+        users = self.jit_users
+
+        def write_mem(a, v):
+            host_write_mem(a, v)
+
+            if users[a]:
+                self.invalidate_jit_address(a)
+
+        self.write_mem = write_mem
+
+    def invalidate_jit(self):
+        self.jit_blocks.clear()
+        self.jit_block_code.clear()
+        self.jit_users[:] = [ None ] * 65536
+
+    def invalidate_jit_address(self, a):
+        for key in list(self.jit_users[a]):
+            del self.jit_blocks[key]
+
+            for c in self.jit_block_code.pop(key):
+                self.jit_users[c].discard(key)
+
+        if self.jit_invalidations[a] < 255:
+            self.jit_invalidations[a] += 1
+
+        # lets a running block stop after the write
+        self.jit_dirty = True
+
+    # for writes that bypass write_mem (see block_copy())
+    def invalidate_jit_range(self, a, n, step):
+        for i in range(0, n):
+            if self.jit_users[a]:
+                self.invalidate_jit_address(a)
+
+            a = (a + step) & 0xffff
+
+    def jit_volatile(self, a):
+        return self.jit_invalidations[a] >= JIT_VOLATILE or self.jit_aliased[a >> 14]
+
+    def jit_interpret(self):
+        pc = self.pc
+        instr = self.read_mem(pc)
+        self.pc = (pc + 1) & 0xffff
+
+        self.debug_opcode(pc, instr)
+
+        return self.main_jumps[instr](instr)
+
+    def jit_translate(self, key):
+        result = translate_block(self, key[0], self.jit_stop_pcs, self.jit_volatile)
+
+        if result:
+            (block, addresses) = result
+
+            self.jit_block_code[key] = addresses
+
+            for a in addresses:
+                if self.jit_users[a] == None:
+                    self.jit_users[a] = set()
+
+                self.jit_users[a].add(key)
+
+        else:
+            block = self.jit_interpret
+
+        self.jit_blocks[key] = block
+
+        return block
+
     def debug(self, x):
         self.debug_out(x)
         self.debug_out(self.reg_str())
         self.debug_out('')
 
+    def debug_opcode(self, pc, instr):
+        # prefixed instructions are logged by their prefix handler
+        if not instr in (0xcb, 0xdd, 0xfd):
+            self.debug('%04x %02x' % (pc, instr))
+
     def reset(self):
         self.a = self.b = self.c = self.d = self.e = self.f = self.h = self.l = 0xff
         self.a_ = self.b_ = self.c_ = self.d_ = self.e_ = self.f_ = self.h_ = self.l_ = 0xff
@@ -42,10 +291,19 @@ class z80:
         self.interrupt_cycles = 0
         self.int = False
 
+        self.block_budget = 0
+        self.block_stop_pcs = ()
+
+        if self.jit:
+            self.invalidate_jit()
+
+    # once per video frame: the VDP always sees the frame (status, display),
+    # the cpu is only interrupted when it and the VDP (IE0) allow it
     def interrupt(self):
+        self.screen.interrupt()
+
         if self.interrupts and self.screen.IE0():
             self.int = True
-            self.screen.interrupt()
 
     def in_(self, a):
         return self.read_io(a)
@@ -74,33 +332,17 @@ class z80:
         return self.m16(high, low)
 
     def flags_add_sub_cp(self, is_sub, carry, value):
-        if is_sub:
-            self.set_flag_n(True)
-            self.set_flag_h((((self.a & 0x0f) - (value & 0x0f)) & 0x10) != 0)
-
-            result = self.a - (value + (self.get_flag_c() if carry else 0))
+        c = self.f & 1 if carry else 0
+        index = (c << 16) | (self.a << 8) | value
 
-        else:
-            self.set_flag_n(False)
-            self.set_flag_h((((self.a & 0x0f) + (value & 0x0f)) & 0x10) != 0)
-
-            result = self.a + value + (self.get_flag_c() if carry else 0)
-
-        self.set_flag_c((result & 0x100) != 0)
-
-        before_sign = self.a & 0x80
-        value_sign = value & 0x80
-        after_sign = result & 0x80
-        self.set_flag_pv(after_sign != before_sign and ((before_sign != value_sign and is_sub) or (before_sign == value_sign and not is_sub)))
+        if is_sub:
+            self.f = FLAGS_SUB[index]
 
-        result &= 0xff
+            return (self.a - value - c) & 0xff
 
-        self.set_flag_z(result == 0)
-        self.set_flag_s(after_sign != 0)
+        self.f = FLAGS_ADD[index]
 
-        self.set_flag_53(result)
-
-        return result
+        return (self.a + value + c) & 0xff
 
     def flags_add_sub_cp16(self, is_sub, carry, org_val, value):
         if is_sub:
@@ -434,10 +676,12 @@ class z80:
         self.main_jumps[0xef] = self._rst
         self.main_jumps[0xff] = self._rst
 
-    def step(self):
-        if self.interrupt_cycles >= 3579545 / 50:
+    def check_interrupt(self):
+        if self.interrupt_cycles >= self.interrupt_interval:
             self.interrupt()
-            self.interrupt_cycles = 0
+
+            # what the last instruction ran over counts for the next frame
+            self.interrupt_cycles -= self.interrupt_interval
 
         if self.int:
             self.int = False
@@ -445,10 +689,12 @@ class z80:
             self.push(self.pc)
             self.pc = 0x38
 
+    def step(self):
+        self.check_interrupt()
+
         instr = self.read_pc_inc()
 
-        if not instr in (0xcb, 0xdd, 0xfd):
-            self.debug('%04x %02x' % (self.pc - 1, instr))
+        self.debug_opcode(self.pc - 1, instr)
 
         try:
             took = self.main_jumps[instr](instr)
@@ -466,6 +712,111 @@ class z80:
 
         return took
 
+    # Executes instructions until at least max_cycles have been spent or
+    # until the program counter reaches one of stop_pcs (checked after
+    # each instruction). Interrupts are only checked once, at the start.
+    # Returns the number of cycles executed.
+    def run(self, max_cycles, stop_pcs=()):
+        if self.jit:
+            return self.run_jit(max_cycles, stop_pcs)
+
+        self.check_interrupt()
+
+        read_mem = self.read_mem
+        main_jumps = self.main_jumps
+
+        done = 0
+
+        try:
+            if self.block_mem:
+                self.block_stop_pcs = stop_pcs
+
+                while done < max_cycles:
+                    pc = self.pc
+                    instr = read_mem(pc)
+                    self.pc = (pc + 1) & 0xffff
+
+                    self.debug_opcode(pc, instr)
+
+                    # see block_repeats()
+                    if instr == 0xed:
+                        self.block_budget = max_cycles - done
+
+                    done += main_jumps[instr](instr)
+
+                    if self.pc in stop_pcs:
+                        break
+
+            elif stop_pcs:
+                while done < max_cycles:
+                    pc = self.pc
+                    instr = read_mem(pc)
+                    self.pc = (pc + 1) & 0xffff
+
+                    self.debug_opcode(pc, instr)
+
+                    done += main_jumps[instr](instr)
+
+                    if self.pc in stop_pcs:
+                        break
+
+            else:
+                while done < max_cycles:
+                    pc = self.pc
+                    instr = read_mem(pc)
+                    self.pc = (pc + 1) & 0xffff
+
+                    self.debug_opcode(pc, instr)
+
+                    done += main_jumps[instr](instr)
+
+        finally:
+            self.cycles += done
+            self.interrupt_cycles += done
+            self.block_budget = 0
+
+        return done
+
+    # The same as run() but executes whole translated blocks at a time, so
+    # stop_pcs is only checked between blocks. Blocks never run past an
+    # address in stop_pcs.
+    def run_jit(self, max_cycles, stop_pcs=()):
+        if not self.jit_stop_pcs.issuperset(stop_pcs):
+            self.jit_stop_pcs.update(stop_pcs)
+            self.invalidate_jit()
+
+        self.check_interrupt()
+
+        blocks = self.jit_blocks
+
+        self.block_stop_pcs = stop_pcs
+
+        done = 0
+
+        try:
+            while done < max_cycles:
+                key = (self.pc, self.mapping)
+
+                block = blocks.get(key)
+
+                if block == None:
+                    block = self.jit_translate(key)
+
+                # a block instruction counts from the start of the block
+                self.block_budget = max_cycles - done
+
+                done += block()
+
+                if self.pc in stop_pcs:
+                    break
+
+        finally:
+            self.cycles += done
+            self.interrupt_cycles += done
+            self.block_budget = 0
+
+        return done
+
     def bits(self, dummy):
         try:
             instr = self.read_pc_inc()
@@ -824,6 +1175,162 @@ class z80:
         self.sp &= 0xffff
         self.write_mem(self.sp, v & 0xff)
 
+    # The repeating block instructions (LDIR, CPIR, INIR, ...) first skip
+    # over the iterations that run() would have executed one by one after
+    # the current one, then do the last of them as usual (which sets the
+    # flags). run() continues with the next iteration while its cycle
+    # budget lasts (21 cycles per iteration) and the program counter (the
+    # instruction itself) is not in stop_pcs; interrupts are not checked
+    # inside run(). step() always executes one iteration.
+    def block_repeats(self, count):
+        if count <= 0 or ((self.pc - 2) & 0xffff) in self.block_stop_pcs:
+            return 0
+
+        return min(count, (self.block_budget - 1) // 21)
+
+    # the number of bytes that can be written from a on (in the direction
+    # of step) before the instruction itself gets overwritten
+    def block_writable(self, a, step):
+        start = (self.pc - 2) & 0xffff
+
+        if step == 1:
+            return min((start - a) & 0xffff, (start + 1 - a) & 0xffff)
+
+        return min((a - start) & 0xffff, (a - start - 1) & 0xffff)
+
+    # returns the (data, index, count) of the plain memory at address a:
+    # count addresses from a on in the direction of step, or None
+    def block_region(self, a, step, write):
+        region = self.block_mem(a, write)
+
+        if not region:
+            return None
+
+        (data, base, first, last) = region
+
+        return (data, a - base, last - a + 1 if step == 1 else a - first + 1)
+
+    # copies up to n bytes like LDIR (step 1) or LDDR (step -1), returns
+    # the number of bytes copied
+    def block_copy(self, src, dst, n, step):
+        done = 0
+
+        while done < n:
+            s = self.block_region(src, step, False)
+            d = self.block_region(dst, step, True)
+
+            if not s or not d:
+                break
+
+            (s_data, si, s_count) = s
+            (d_data, di, d_count) = d
+
+            m = min(n - done, s_count, d_count)
+
+            if step == 1:
+                if s_data is d_data and si < di < si + m:
+                    # the destination overlaps the source: LDIR repeats
+                    # the first di - si bytes (e.g. a fill with DE = HL + 1)
+                    pattern = s_data[si:di]
+                    d_data[di:di + m] = (pattern * (m // len(pattern) + 1))[0:m]
+
+                else:
+                    d_data[di:di + m] = s_data[si:si + m]
+
+            elif s_data is d_data and di < si < di + m:
+                for i in range(0, m):
+                    d_data[di - i] = d_data[si - i]
+
+            else:
+                d_data[di - m + 1:di + 1] = s_data[si - m + 1:si + 1]
+
+            if self.jit:
+                self.invalidate_jit_range(dst, m, step)
+
+            done += m
+            src = (src + m * step) & 0xffff
+            dst = (dst + m * step) & 0xffff
+
+        return done
+
+    # returns how many of the n bytes from a on (in the direction of step)
+    # differ from v, like CPIR/CPDR would look for it
+    def block_find(self, a, v, n, step):
+        done = 0
+
+        while done < n:
+            r = self.block_region(a, step, False)
+
+            if not r:
+                break
+
+            (data, i, count) = r
+
+            m = min(n - done, count)
+
+            chunk = data[i:i + m] if step == 1 else data[i - m + 1:i + 1][::-1]
+
+            if v in chunk:
+                return done + chunk.index(v)
+
+            done += m
+            a = (a + m * step) & 0xffff
+
+        return done
+
+    def block_ld(self, step):
+        bc = self.m16(self.b, self.c)
+        n = self.block_repeats((bc - 1) & 0xffff)
+
+        if n > 0:
+            hl = self.m16(self.h, self.l)
+            de = self.m16(self.d, self.e)
+
+            n = self.block_copy(hl, de, min(n, self.block_writable(de, step)), step)
+
+            (self.b, self.c) = self.u16((bc - n) & 0xffff)
+            (self.d, self.e) = self.u16((de + n * step) & 0xffff)
+            (self.h, self.l) = self.u16((hl + n * step) & 0xffff)
+
+            if n > 0:
+                self.memptr = (self.pc - 1) & 0xffff
+
+        return max(n, 0)
+
+    def block_cp(self, step):
+        bc = self.m16(self.b, self.c)
+        n = self.block_repeats((bc - 1) & 0xffff)
+
+        if n > 0:
+            hl = self.m16(self.h, self.l)
+
+            # the iteration that finds A is the last one
+            n = self.block_find(hl, self.a, n, step)
+
+            (self.b, self.c) = self.u16((bc - n) & 0xffff)
+            (self.h, self.l) = self.u16((hl + n * step) & 0xffff)
+
+            if n > 0:
+                self.memptr = (self.pc - 1) & 0xffff
+
+        return max(n, 0)
+
+    # INIR reads I/O, so this only saves the instruction dispatch
+    def block_in(self):
+        hl = self.m16(self.h, self.l)
+        n = min(self.block_repeats((self.b - 1) & 0xff), self.block_writable(hl, 1))
+
+        if n > 0:
+
+            for i in range(0, n):
+                self.write_mem(hl, self.in_(self.c))
+                hl = (hl + 1) & 0xffff
+
+            (self.h, self.l) = self.u16(hl)
+            self.b = (self.b - n) & 0xff
+
+        return max(n, 0)
+
     def set_flag_53(self, value):
         assert value >= 0 and value <= 255
         self.f &= ~0x28
@@ -912,13 +1419,7 @@ class z80:
         return 4
 
     def or_flags(self):
-        self.set_flag_c(False)
-        self.set_flag_z(self.a == 0)
-        self.set_flag_parity()
-        self.set_flag_s(self.a >= 128)
-        self.set_flag_n(False)
-        self.set_flag_h(False)
-        self.set_flag_53(self.a)
+        self.f = FLAGS_SZ53P[self.a]
 
     def _or(self, instr):
         src = instr & 7
@@ -940,13 +1441,7 @@ class z80:
         return 7
 
     def and_flags(self):
-        self.set_flag_c(False)
-        self.set_flag_z(self.a == 0)
-        self.set_flag_parity()
-        self.set_flag_s(self.a >= 128)
-        self.set_flag_n(False)
-        self.set_flag_h(True)
-        self.set_flag_53(self.a)
+        self.f = FLAGS_SZ53P[self.a] | 0x10
 
     def _and(self, instr):
         src = instr & 7
@@ -968,13 +1463,7 @@ class z80:
         return 7
 
     def xor_flags(self):
-        self.set_flag_c(False)
-        self.set_flag_z(self.a == 0)
-        self.set_flag_parity()
-        self.set_flag_s(self.a >= 128)
-        self.set_flag_n(False)
-        self.set_flag_h(False)
-        self.set_flag_53(self.a)
+        self.f = FLAGS_SZ53P[self.a]
 
     def _xor(self, instr):
         src = instr & 7
@@ -1118,18 +1607,11 @@ class z80:
         (val, name) = self.get_src(src)
 
         old_7 = val & 128
-        self.set_flag_c((val & 1) == 1)
+        c = val & 1
         val >>= 1
         val |= old_7
 
-        self.set_flag_z(val == 0)
-        self.set_flag_pv(self.parity(val & 0xff))
-        self.set_flag_s((val & 128) == 128)
-        self.set_flag_n(False)
-        self.set_flag_h(False)
-
-        val &= 255;
-        self.set_flag_53(val)
+        self.f = FLAGS_SZ53P[val] | c
 
         dst = src
         self.set_dst(dst, val)
@@ -1146,18 +1628,11 @@ class z80:
         val = self.read_mem(a)
 
         old_7 = val & 128
-        self.set_flag_c((val & 1) == 1)
+        c = val & 1
         val >>= 1
         val |= old_7
 
-        self.set_flag_z(val == 0)
-        self.set_flag_pv(self.parity(val & 0xff))
-        self.set_flag_s((val & 128) == 128)
-        self.set_flag_n(False)
-        self.set_flag_h(False)
-
-        val &= 255;
-        self.set_flag_53(val)
+        self.f = FLAGS_SZ53P[val] | c
 
         self.write_mem(a, val)
 
@@ -1404,15 +1879,7 @@ class z80:
         return 6
 
     def inc_flags(self, before):
-        before = self.compl8(before)
-        after = self.compl8((before + 1) & 0xff)
-
-        self.set_flag_z(after == 0)
-        self.set_flag_pv(before >= 0 and after < 0)
-        self.set_flag_s(after < 0)
-        self.set_flag_n(False)
-        self.set_flag_h(not (after & 0x0f))
-        self.set_flag_53(after & 0xff)
+        self.f = (self.f & 1) | FLAGS_INC[before]
 
     def _inc_high(self, instr):
         which = instr >> 4
@@ -1538,18 +2005,7 @@ class z80:
         return 6
 
     def dec_flags(self, before):
-        after = before - 1
-
-        self.set_flag_n(True)
-        self.set_flag_h((after & 0x0f) == 0x0f)
-        self.set_flag_z(after == 0x00)
-        self.set_flag_s((after & 0x80) == 0x80)
-
-        before_sign = before & 0x80
-        value_sign = -1 & 0x80
-        after_sign = after & 0x80
-        self.set_flag_pv(before_sign and not after_sign)
-        self.set_flag_53(after & 0xff)
+        self.f = (self.f & 1) | FLAGS_DEC[before]
 
     def _dec_high(self, instr):
         which = instr >> 4
@@ -1990,16 +2446,16 @@ class z80:
         self.set_flag_n(False)
         self.set_flag_h(False)
 
-        self.a <<= 1
+        a = self.a << 1
 
-        if self.a & 0x100:
+        if a & 0x100:
             self.set_flag_c(True)
-            self.a |= 1
+            a |= 1
 
         else:
             self.set_flag_c(False)
 
-        self.a &= 0xff
+        self.a = a & 0xff
         self.set_flag_53(self.a)
 
         self.debug('RLCA')
@@ -2009,18 +2465,18 @@ class z80:
         self.set_flag_n(False)
         self.set_flag_h(False)
 
-        self.a <<= 1
+        a = self.a << 1
 
         if self.get_flag_c():
-            self.a |= 1
+            a |= 1
 
-        if self.a & 0x100:
+        if a & 0x100:
             self.set_flag_c(True)
 
         else:
             self.set_flag_c(False)
 
-        self.a &= 0xff
+        self.a = a & 0xff
         self.set_flag_53(self.a)
 
         self.debug('RLA')
@@ -2030,27 +2486,13 @@ class z80:
         src = instr & 0x7
         (val, name) = self.get_src(src)
 
-        self.set_flag_n(False)
-        self.set_flag_h(False)
-
-        val <<= 1
-
-        if val & 0x100:
-            self.set_flag_c(True)
-            val |= 1
-
-        else:
-            self.set_flag_c(False)
-
-        val &= 0xff
+        c = val >> 7
+        val = ((val << 1) | c) & 0xff
 
         dst = src
         self.set_dst(dst, val)
 
-        self.set_flag_pv(self.parity(val))
-        self.set_flag_s((val & 0x80) == 0x80)
-        self.set_flag_z(val == 0)
-        self.set_flag_53(val)
+        self.f = FLAGS_SZ53P[val] | c
 
         self.debug('RLC %s' % name)
         return 15 if src == 6 else 8
@@ -2065,19 +2507,8 @@ class z80:
         val = self.read_mem(a)
         self.debug('rlc address is %04x: %02x' % (a, val))
 
-        self.set_flag_n(False)
-        self.set_flag_h(False)
-
-        val <<= 1
-
-        if val & 0x100:
-            self.set_flag_c(True)
-            val |= 1
-
-        else:
-            self.set_flag_c(False)
-
-        val &= 0xff
+        c = val >> 7
+        val = ((val << 1) | c) & 0xff
 
         self.write_mem(a, val)
 
@@ -2087,30 +2518,21 @@ class z80:
         else:
             dst_name = ''
 
-        self.set_flag_pv(self.parity(val))
-        self.set_flag_s((val & 0x80) == 0x80)
-        self.set_flag_z(val == 0)
-        self.set_flag_53(val)
+        self.f = FLAGS_SZ53P[val] | c
 
         self.debug('RLC (%s + 0x%02x), %s' % (name, offset, dst_name))
         return 23
 
     def _rrc(self, instr):
         src = instr & 7
-        self.set_flag_n(False)
-        self.set_flag_h(False)
 
         (val, name) = self.get_src(src)
         old_0 = val & 1
-        self.set_flag_c(old_0 == 1)
 
         val >>= 1
         val |= old_0 << 7
 
-        self.set_flag_pv(self.parity(val))
-        self.set_flag_z(val == 0)
-        self.set_flag_s(val >= 128)
-        self.set_flag_53(val)
+        self.f = FLAGS_SZ53P[val] | old_0
 
         dst = src
         self.set_dst(dst, val)
@@ -2127,19 +2549,12 @@ class z80:
         val = self.read_mem(a)
         self.debug('rrc address is %04x: %02x' % (a, val))
 
-        self.set_flag_n(False)
-        self.set_flag_h(False)
-
         old_0 = val & 1
-        self.set_flag_c(old_0 == 1)
 
         val >>= 1
         val |= old_0 << 7
 
-        self.set_flag_pv(self.parity(val))
-        self.set_flag_z(val == 0)
-        self.set_flag_s(val >= 128)
-        self.set_flag_53(val)
+        self.f = FLAGS_SZ53P[val] | old_0
 
         self.write_mem(a, val)
 
@@ -2162,6 +2577,11 @@ class z80:
         return 7
 
     def _ldd_ldi_r(self, instr):
+        skipped = 0
+
+        if (instr == 0xb0 or instr == 0xb8) and self.block_mem:  # LDIR / LDDR
+            skipped = self.block_ld(1 if instr == 0xb0 else -1)
+
         self.set_flag_n(False)
         self.set_flag_pv(False)
         self.set_flag_h(False)
@@ -2216,24 +2636,18 @@ class z80:
         self.f |= 0x08 if (temp & (1 << 3)) else 0
 
         self.debug(name)
-        return cycles
+        return cycles + skipped * 21
 
     def _rl(self, instr):
         src = instr & 7
-        self.set_flag_n(False)
-        self.set_flag_h(False)
 
         (val, name) = self.get_src(src)
         val <<= 1
         val |= self.get_flag_c()
-        self.set_flag_c(val > 255)
+        c = val >> 8
         val &= 0xff
 
-        self.set_flag_pv(self.parity(val))
-        self.set_flag_z(val == 0)
-        self.set_flag_s(val >= 128)
-
-        self.set_flag_53(val)
+        self.f = FLAGS_SZ53P[val] | c
 
         dst = src
         self.set_dst(dst, val)
@@ -2250,18 +2664,12 @@ class z80:
         self.memptr = a
         val = self.read_mem(a)
 
-        self.set_flag_n(False)
-        self.set_flag_h(False)
-
         val <<= 1
         val |= self.get_flag_c()
-        self.set_flag_c(val > 255)
+        c = val >> 8
         val &= 0xff
 
-        self.set_flag_pv(self.parity(val))
-        self.set_flag_z(val == 0)
-        self.set_flag_s(val >= 128)
-        self.set_flag_53(val)
+        self.f = FLAGS_SZ53P[val] | c
 
         self.write_mem(a, val)
 
@@ -2276,21 +2684,15 @@ class z80:
 
     def _rr(self, instr):
         src = instr & 7
-        self.set_flag_n(False)
-        self.set_flag_h(False)
 
         (val, name) = self.get_src(src)
         old_c = self.get_flag_c()
-        self.set_flag_c((val & 1) == 1)
+        c = val & 1
 
         val >>= 1
         val |= old_c << 7
 
-        self.set_flag_pv(self.parity(val))
-        self.set_flag_z(val == 0)
-        self.set_flag_s(val >= 128)
-
-        self.set_flag_53(val)
+        self.f = FLAGS_SZ53P[val] | c
 
         dst = src
         self.set_dst(dst, val)
@@ -2307,18 +2709,12 @@ class z80:
         self.memptr = a
         val = self.read_mem(a)
 
-        self.set_flag_n(False)
-        self.set_flag_h(False)
-
         old_c = self.get_flag_c()
-        self.set_flag_c((val & 1) == 1)
+        c = val & 1
         val >>= 1
         val |= old_c << 7
 
-        self.set_flag_pv(self.parity(val))
-        self.set_flag_z(val == 0)
-        self.set_flag_s(val >= 128)
-        self.set_flag_53(val)
+        self.f = FLAGS_SZ53P[val] | c
 
         self.write_mem(a, val)
 
@@ -2774,6 +3170,11 @@ class z80:
         return 21  # FIXME or 16?
 
     def _cpi_cpd_r(self, instr):
+        skipped = 0
+
+        if (instr == 0xb1 or instr == 0xb9) and self.block_mem:  # CPIR / CPDR
+            skipped = self.block_cp(1 if instr == 0xb1 else -1)
+
         hl = self.m16(self.h, self.l)
         bc = self.m16(self.b, self.c)
 
@@ -2826,7 +3227,7 @@ class z80:
 
         self.debug(name)
 
-        return cycles
+        return cycles + skipped * 21
 
     def _and_a_ixy_deref(self, instr, is_ix):
         offset = self.compl8(self.read_pc_inc())
@@ -2916,16 +3317,18 @@ class z80:
             else:
                 self.set_flag_h((self.a & 0x0f) >= 0x0a)
 
+        a = self.a
+
         if t == 1:
-            self.a += 0xfa if self.get_flag_n() else 0x06
+            a += 0xfa if self.get_flag_n() else 0x06
 
         elif t == 2:
-            self.a += 0xa0 if self.get_flag_n() else 0x60
+            a += 0xa0 if self.get_flag_n() else 0x60
 
         elif t == 3:
-            self.a += 0x9a if self.get_flag_n() else 0x66
+            a += 0x9a if self.get_flag_n() else 0x66
 
-        self.a &= 0xff
+        self.a = a & 0xff
 
         self.set_flag_s((self.a & 128) == 128)
         self.set_flag_z(self.a == 0x00)
@@ -3376,6 +3779,11 @@ class z80:
         return 23
 
     def _ini_r(self, instr):
+        skipped = 0
+
+        if instr == 0xb2:  # INIR
+            skipped = self.block_in()
+
         v = self.in_(self.c)
 
         hl = self.m16(self.h, self.l)
@@ -3405,4 +3813,398 @@ class z80:
 
         self.debug('INIR' if instr == 0xb2 else 'INI')
 
-        return cycles
+        return cycles + skipped * 21
+
+LAZY_ADD_SUB = 1
+LAZY_LOGIC = 2
+LAZY_INC = 3
+LAZY_DEC = 4
+
+# Only records the operands of the 8 bit ALU operations that overwrite (nearly)
+# all flags; F is calculated when it is actually read (get_flag_*, PUSH AF,
+# EX AF, etc.). Results are identical to those of the z80 class.
+class z80_lazy_flags(z80):
+    # lazy and _f are in z80.__slots__
+    __slots__ = ( )
+
+    def get_f(self):
+        if self.lazy:
+            self.materialize_flags()
+
+        return self._f
+
+    def set_f(self, v):
+        self.lazy = None
+        self._f = v
+
+    f = property(get_f, set_f)
+
+    def materialize_flags(self):
+        lazy = self.lazy
+        self.lazy = None
+        kind = lazy[0]
+
+        if kind == LAZY_ADD_SUB:
+            (kind, table, index, result, v53) = lazy
+            f = table[index]
+
+        elif kind == LAZY_LOGIC:
+            (kind, result, h, v53) = lazy
+            f = FLAGS_SZ53P[result] | h
+
+        elif kind == LAZY_INC:
+            (kind, before, c, v53) = lazy
+            f = FLAGS_INC[before] | c
+
+        elif kind == LAZY_DEC:
+            (kind, before, c, v53) = lazy
+            f = FLAGS_DEC[before] | c
+
+        else:
+            assert False
+
+        self._f = (f & ~0x28) | (v53 & 0x28)
+
+    def flags_add_sub_cp(self, is_sub, carry, value):
+        c = self.get_flag_c() if carry else 0
+        index = (c << 16) | (self.a << 8) | value
+
+        if is_sub:
+            result = self.a - value - c
+            self.lazy = (LAZY_ADD_SUB, FLAGS_SUB, index, result, result & 0xff)
+
+        else:
+            result = self.a + value + c
+            self.lazy = (LAZY_ADD_SUB, FLAGS_ADD, index, result, result & 0xff)
+
+        return result & 0xff
+
+    def and_flags(self):
+        self.lazy = (LAZY_LOGIC, self.a, 16, self.a)
+
+    def or_flags(self):
+        self.lazy = (LAZY_LOGIC, self.a, 0, self.a)
+
+    def xor_flags(self):
+        self.lazy = (LAZY_LOGIC, self.a, 0, self.a)
+
+    def inc_flags(self, before):
+        self.lazy = (LAZY_INC, before, self.get_flag_c(), (before + 1) & 0xff)
+
+    def dec_flags(self, before):
+        self.lazy = (LAZY_DEC, before, self.get_flag_c(), (before - 1) & 0xff)
+
+    def set_flag_53(self, value):
+        assert value >= 0 and value <= 255
+
+        if self.lazy:
+            self.lazy = self.lazy[:-1] + (value, )
+
+        else:
+            self._f = (self._f & ~0x28) | (value & 0x28)
+
+    def get_flag_c(self):
+        lazy = self.lazy
+
+        if lazy:
+            kind = lazy[0]
+
+            if kind == LAZY_ADD_SUB:
+                return (lazy[3] & 0x100) != 0
+
+            if kind == LAZY_LOGIC:
+                return False
+
+            return lazy[2] == 1
+
+        return (self._f & 1) != 0
+
+    def get_flag_z(self):
+        lazy = self.lazy
+
+        if lazy:
+            kind = lazy[0]
+
+            if kind == LAZY_ADD_SUB:
+                return (lazy[3] & 0xff) == 0
+
+            if kind == LAZY_LOGIC:
+                return lazy[1] == 0
+
+            if kind == LAZY_INC:
+                return lazy[1] == 0xff
+
+            return lazy[1] == 0x01
+
+        return (self._f & 64) != 0
+
+    # the other flag accessors work on _f directly to avoid the property
+
+    def set_flag_c(self, v):
+        assert v == False or v == True
+        if self.lazy:
+            self.materialize_flags()
+        self._f = (self._f & ~1) | v
+
+    def set_flag_n(self, v):
+        assert v == False or v == True
+        if self.lazy:
+            self.materialize_flags()
+        self._f = (self._f & ~2) | (v << 1)
+
+    def get_flag_n(self):
+        if self.lazy:
+            self.materialize_flags()
+        return (self._f & 2) != 0
+
+    def set_flag_pv(self, v):
+        assert v == False or v == True
+        if self.lazy:
+            self.materialize_flags()
+        self._f = (self._f & ~4) | (v << 2)
+
+    def get_flag_pv(self):
+        if self.lazy:
+            self.materialize_flags()
+        return (self._f & 4) != 0
+
+    def set_flag_h(self, v):
+        assert v == False or v == True
+        if self.lazy:
+            self.materialize_flags()
+        self._f = (self._f & ~16) | (v << 4)
+
+    def get_flag_h(self):
+        if self.lazy:
+            self.materialize_flags()
+        return (self._f & 16) != 0
+
+    def set_flag_z(self, v):
+        assert v == False or v == True
+        if self.lazy:
+            self.materialize_flags()
+        self._f = (self._f & ~64) | (v << 6)
+
+    def set_flag_s(self, v):
+        assert v == False or v == True
+        if self.lazy:
+            self.materialize_flags()
+        self._f = (self._f & ~128) | (v << 7)
+
+    def get_flag_s(self):
+        if self.lazy:
+            self.materialize_flags()
+        return (self._f & 128) != 0
+
+PROFILE_PREFIXES = { 0xcb: 'CB', 0xdd: 'DD', 0xed: 'ED', 0xfd: 'FD' }
+
+# Counts the executed instructions: per opcode, per opcode after each of
+# the prefixes and per program counter (executions and cycles). Runs the
+# interpreter, so it can not be combined with the jit. A repeating block
+# instruction that run() does in bulk (see block_repeats()) counts as one
+# execution with the cycles of all its iterations.
+class z80_profile(z80):
+    # the profile_* counters are in z80.__slots__
+    __slots__ = ( )
+
+    def init_profile(self):
+        self.profile_opcodes = array('Q', [ 0 ]) * 256
+        self.profile_prefixed = { }
+
+        for name in ('CB', 'ED', 'DD', 'FD', 'DDCB', 'FDCB'):
+            self.profile_prefixed[name] = array('Q', [ 0 ]) * 256
+
+        self.profile_pc_counts = array('Q', [ 0 ]) * 65536
+        self.profile_pc_cycles = array('Q', [ 0 ]) * 65536
+
+        # for the names in the report
+        self.profile_tables = { '': self.main_jumps, 'CB': self.bits_jumps, 'ED': self.ed_jumps, 'DD': self.ixy_jumps, 'FD': self.ixy_jumps, 'DDCB': self.ixy_bit_jumps, 'FDCB': self.ixy_bit_jumps }
+
+    # looks ahead at the opcode following a prefix, before it executes
+    def profile_prefix(self, pc, instr):
+        name = PROFILE_PREFIXES[instr]
+        sub = self.read_mem((pc + 1) & 0xffff)
+
+        if sub == 0xcb and instr in (0xdd, 0xfd):
+            name += 'CB'
+            sub = self.read_mem((pc + 3) & 0xffff)
+
+        self.profile_prefixed[name][sub] += 1
+
+    def profile_count(self, pc, instr, took):
+        self.profile_opcodes[instr] += 1
+        self.profile_pc_counts[pc] += 1
+        self.profile_pc_cycles[pc] += took
+
+    def step(self):
+        self.check_interrupt()
+
+        pc = self.pc
+        instr = self.read_mem(pc)
+        self.pc = (pc + 1) & 0xffff
+
+        self.debug_opcode(pc, instr)
+
+        if instr in PROFILE_PREFIXES:
+            self.profile_prefix(pc, instr)
+
+        took = self.main_jumps[instr](instr)
+        self.cycles += took
+        self.interrupt_cycles += took
+
+        self.profile_count(pc, instr, took)
+
+        return took
+
+    def run(self, max_cycles, stop_pcs=()):
+        self.check_interrupt()
+
+        read_mem = self.read_mem
+        main_jumps = self.main_jumps
+        opcodes = self.profile_opcodes
+        pc_counts = self.profile_pc_counts
+        pc_cycles = self.profile_pc_cycles
+        block_mem = self.block_mem
+
+        done = 0
+
+        self.block_stop_pcs = stop_pcs
+
+        try:
+            while done < max_cycles:
+                pc = self.pc
+                instr = read_mem(pc)
+                self.pc = (pc + 1) & 0xffff
+
+                self.debug_opcode(pc, instr)
+
+                if instr in PROFILE_PREFIXES:
+                    self.profile_prefix(pc, instr)
+
+                # see block_repeats()
+                if instr == 0xed and block_mem:
+                    self.block_budget = max_cycles - done
+
+                took = main_jumps[instr](instr)
+                done += took
+
+                opcodes[instr] += 1
+                pc_counts[pc] += 1
+                pc_cycles[pc] += took
+
+                if self.pc in stop_pcs:
+                    break
+
+        finally:
+            self.cycles += done
+            self.interrupt_cycles += done
+            self.block_budget = 0
+
+        return done
+
+    def profile_handler_name(self, table, instr):
+        method = self.profile_tables[table][instr]
+
+        return method.__name__ if method else '?'
+
+    # returns [ (opcode, count, handler name) ] sorted by count
+    def profile_opcode_list(self, table):
+        counts = self.profile_prefixed[table] if table else self.profile_opcodes
+
+        return [ (i, counts[i], self.profile_handler_name(table, i)) for i in sorted(range(0, 256), key=lambda i: -counts[i]) if counts[i] ]
+
+    # returns [ (pc, count, cycles) ] sorted by cycles
+    def profile_pc_list(self):
+        cycles = self.profile_pc_cycles
+
+        return [ (pc, self.profile_pc_counts[pc], cycles[pc]) for pc in sorted(range(0, 65536), key=lambda pc: -cycles[pc]) if cycles[pc] ]
+
+    def profile_json(self):
+        out = { 'instructions': sum(self.profile_pc_counts), 'cycles': sum(self.profile_pc_cycles) }
+
+        for table in ('', ) + tuple(self.profile_prefixed):
+            out['opcodes' + table] = [ { 'opcode': '%02x' % i, 'count': count, 'handler': name } for (i, count, name) in self.profile_opcode_list(table) ]
+
+        out['pcs'] = [ { 'pc': '%04x' % pc, 'count': count, 'cycles': cycles } for (pc, count, cycles) in self.profile_pc_list() ]
+
+        return out
+
+    def profile_report(self, fh, n=25):
+        instructions = sum(self.profile_pc_counts)
+        total_cycles = max(sum(self.profile_pc_cycles), 1)
+
+        print('%d instructions, %d cycles' % (instructions, total_cycles), file=fh)
+
+        for table in ('', ) + tuple(self.profile_prefixed):
+            opcodes = self.profile_opcode_list(table)
+
+            if not opcodes:
+                continue
+
+            print('', file=fh)
+            print('%-6s %12s %7s  handler' % (table + 'op', 'count', '%'), file=fh)
+
+            for (i, count, name) in opcodes[0:n]:
+                print('%-6s %12d %6.2f%%  %s' % ('%02x' % i, count, count * 100.0 / instructions, name), file=fh)
+
+        print('', file=fh)
+        print('%-6s %12s %12s %7s' % ('pc', 'count', 'cycles', '%'), file=fh)
+
+        for (pc, count, cycles) in self.profile_pc_list()[0:n]:
+            print('%04x   %12d %12d %6.2f%%' % (pc, count, cycles, cycles * 100.0 / total_cycles), file=fh)
+
+    # writes JSON when the filename ends in .json, else the text report
+    def write_profile(self, filename):
+        fh = open(filename, 'w')
+
+        if filename.endswith('.json'):
+            json.dump(self.profile_json(), fh, indent=1)
+
+        else:
+            self.profile_report(fh)
+
+        fh.close()
+
+variants = { }
+
+def get_variant_class(trace, lazy_flags, profile=False):
+    key = (trace, lazy_flags, profile)
+
+    if not key in variants:
+        cls = z80 if trace else get_untraced_class()
+
+        if lazy_flags:
+            cls = type('%s_lazy_flags' % cls.__name__, (z80_lazy_flags, cls), { '__slots__': ( ) })
+
+        if profile:
+            cls = type('%s_profile' % cls.__name__, (z80_profile, cls), { '__slots__': ( ) })
+
+        variants[key] = cls
+
+    return variants[key]
+
+untraced_class = None
+
+# Builds a z80 subclass in which every "self.debug...(...)" statement of
+# the handlers is removed (what the sed-command from the README did), so
+# that no trace strings are formatted at all.
+def get_untraced_class():
+    global untraced_class
+
+    if not untraced_class:
+        (lines, first_line) = inspect.getsourcelines(z80)
+
+        src = ''.join(lines)
+        src = src.replace('class z80:', 'class z80_untraced(z80):', 1)
+
+        # keep line numbers in tracebacks identical to z80.py
+        src = '\n' * (first_line - 1) + src
+
+        tree = strip_trace(ast.parse(src))
+
+        scope = dict(globals())
+        exec(compile(tree, inspect.getsourcefile(z80), 'exec'), scope)
+
+        untraced_class = scope['z80_untraced']
+
+    return untraced_class
@@ -0,0 +1,1095 @@
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+# Generates the fully decoded handler tables for the z80 class. Each
+# generic handler (e.g. _ld, _jp_wrap) is partially evaluated for one
+# opcode: the opcode (and for DD/FD the IX/IY selection) becomes a
+# constant, if/elif chains on it are folded away, register access
+# helpers like get_src() and set_dst() are replaced by the attribute
+# they select and small helper methods are inlined.
+
+import ast
+import copy
+import inspect
+import linecache
+import operator
+import re
+import textwrap
+
+# a self.debug...(...) call as a statement of its own
+def is_debug_call(node):
+    return isinstance(node, ast.Expr) and isinstance(node.value, ast.Call) and isinstance(node.value.func, ast.Attribute) and isinstance(node.value.func.value, ast.Name) and node.value.func.value.id == 'self' and node.value.func.attr.startswith('debug')
+
+class trace_stripper(ast.NodeTransformer):
+    def generic_visit(self, node):
+        super().generic_visit(node)
+
+        for (field, value) in ast.iter_fields(node):
+            if isinstance(value, list) and value and isinstance(value[0], ast.stmt):
+                body = [ s for s in value if not is_debug_call(s) ]
+
+                setattr(node, field, body or [ ast.copy_location(ast.Pass(), value[0]) ])
+
+        return node
+
+# removes every self.debug...(...) statement from the tree (in place), so
+# that no trace strings are formatted at all
+def strip_trace(tree):
+    return trace_stripper().visit(tree)
+
+REGS8 = ( 'self.b', 'self.c', 'self.d', 'self.e', 'self.h', 'self.l', None, 'self.a' )
+REG_NAMES8 = ( 'B', 'C', 'D', 'E', 'H', 'L', '(HL)', 'A' )
+PAIRS = ( ('self.b', 'self.c'), ('self.d', 'self.e'), ('self.h', 'self.l'), None )
+PAIR_NAMES = ( 'BC', 'DE', 'HL', 'SP' )
+FLAG_BITS = { 'c': 0, 'n': 1, 'pv': 2, 'h': 4, 'z': 6, 's': 7 }
+
+# handlers that switch to another table; these get a generated dispatcher
+PREFIXES = ( 'bits', 'ed', '_ix', '_iy', 'ixy_bit' )
+
+MAX_INLINE_DEPTH = 4
+
+BIN_OPS = { ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.FloorDiv: operator.floordiv, ast.Mod: operator.mod, ast.LShift: operator.lshift, ast.RShift: operator.rshift, ast.BitAnd: operator.and_, ast.BitOr: operator.or_, ast.BitXor: operator.xor }
+UNARY_OPS = { ast.USub: operator.neg, ast.Invert: operator.invert, ast.Not: operator.not_ }
+COMPARE_OPS = { ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt, ast.LtE: operator.le, ast.Gt: operator.gt, ast.GtE: operator.ge, ast.In: lambda a, b: a in b, ast.NotIn: lambda a, b: a not in b, ast.Is: operator.is_, ast.IsNot: operator.is_not }
+
+PC_STORE = re.compile(r'self\.pc\s*[-+&]?=[^=]')
+MEMORY_WRITE = re.compile(r'self\.write_mem\(')
+CALLED_METHODS = re.compile(r'self\.(\w+)\(')
+
+class cannot_specialize(Exception):
+    pass
+
+def parse_expr(src):
+    return ast.parse(src, mode='eval').body
+
+def parse_stmts(src):
+    return ast.parse(src).body
+
+def is_self_call(node):
+    return isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and isinstance(node.func.value, ast.Name) and node.func.value.id == 'self'
+
+def is_pc(node):
+    return isinstance(node, ast.Attribute) and node.attr == 'pc' and isinstance(node.value, ast.Name) and node.value.id == 'self'
+
+def stores_pc(stmts):
+    return any(is_pc(n) and not isinstance(n.ctx, ast.Load) for s in stmts for n in ast.walk(s))
+
+def is_simple(node):
+    return isinstance(node, (ast.Name, ast.Constant)) or (isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name))
+
+def body_or_pass(stmts):
+    return stmts if stmts else [ ast.Pass() ]
+
+class substitute(ast.NodeTransformer):
+    def __init__(self, names):
+        self.names = names
+
+    def visit_Name(self, node):
+        if node.id in self.names:
+            return copy.deepcopy(self.names[node.id])
+
+        return node
+
+def template(src, **names):
+    return [ substitute(names).visit(s) for s in parse_stmts(src) ]
+
+class rename(ast.NodeTransformer):
+    def __init__(self, names, prefix):
+        self.names = names
+        self.prefix = prefix
+
+    def visit_Name(self, node):
+        if node.id in self.names:
+            node.id = self.prefix + node.id
+
+        return node
+
+def count_stores(fdef):
+    counts = { }
+
+    for node in ast.walk(fdef):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store):
+            counts[node.id] = counts.get(node.id, 0) + 1
+
+    return counts
+
+# ast.unparse() wants a line number on every statement; only these need
+# one so this is a lot cheaper than ast.fix_missing_locations()
+def set_line_numbers(stmts):
+    for s in stmts:
+        s.lineno = 1
+
+        for field in ('body', 'orelse'):
+            set_line_numbers(getattr(s, field, [ ]))
+
+# removes assignments to locals that are never read (e.g. the mnemonic
+# names that are only used by the trace output)
+def remove_dead_stores(stmts):
+    while True:
+        loaded = set()
+
+        for s in stmts:
+            for node in ast.walk(s):
+                if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load):
+                    loaded.add(node.id)
+
+                elif isinstance(node, ast.AugAssign) and isinstance(node.target, ast.Name):
+                    loaded.add(node.target.id)
+
+        (stmts, changed) = strip_stores(stmts, loaded)
+
+        if not changed:
+            return stmts
+
+def is_dead_store(s, loaded):
+    if not isinstance(s, ast.Assign) or any(isinstance(n, ast.Call) for n in ast.walk(s.value)):
+        return False
+
+    for t in s.targets:
+        for n in ast.walk(t):
+            if not isinstance(n, (ast.Name, ast.Tuple, ast.Store)) or (isinstance(n, ast.Name) and n.id in loaded):
+                return False
+
+    return True
+
+def strip_stores(stmts, loaded):
+    out = [ ]
+    changed = False
+
+    for s in stmts:
+        if is_dead_store(s, loaded):
+            changed = True
+            continue
+
+        for field in ('body', 'orelse'):
+            if hasattr(s, field):
+                (new_stmts, field_changed) = strip_stores(getattr(s, field), loaded)
+                setattr(s, field, body_or_pass(new_stmts) if field == 'body' else new_stmts)
+                changed |= field_changed
+
+        out.append(s)
+
+    return (out, changed)
+
+def has_nested_return(stmts):
+    for s in stmts:
+        for node in ast.walk(s):
+            if isinstance(node, ast.Return) and node is not s:
+                return True
+
+    return False
+
+class folder(ast.NodeTransformer):
+    def __init__(self, spec, env):
+        self.spec = spec
+        self.env = env
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Load) and node.id in self.env:
+            value = self.env[node.id]
+
+            # a local that is only a copy of another one
+            if isinstance(value, ast.Name):
+                return ast.Name(value.id, ast.Load())
+
+            return ast.Constant(value)
+
+        return node
+
+    def constant(self, node):
+        try:
+            if isinstance(node, ast.BinOp):
+                return ast.Constant(BIN_OPS[type(node.op)](node.left.value, node.right.value))
+
+            if isinstance(node, ast.UnaryOp):
+                return ast.Constant(UNARY_OPS[type(node.op)](node.operand.value))
+
+            left = node.left.value
+
+            for (op, right) in zip(node.ops, node.comparators):
+                if not COMPARE_OPS[type(op)](left, right.value):
+                    return ast.Constant(False)
+
+                left = right.value
+
+            return ast.Constant(True)
+
+        except (KeyError, ArithmeticError, TypeError):
+            return node
+
+    def all_constant(self, nodes):
+        return all(isinstance(n, ast.Constant) for n in nodes)
+
+    # True when node evaluates to an int, also for bool operands
+    def is_int(self, node):
+        if not isinstance(node, ast.BinOp):
+            return False
+
+        if isinstance(node.op, ast.BitAnd):
+            return any(isinstance(n, ast.Constant) and type(n.value) == int for n in (node.left, node.right))
+
+        return not isinstance(node.op, (ast.BitOr, ast.BitXor))
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+
+        if self.all_constant((node.left, node.right)):
+            return self.constant(node)
+
+        # x | 0, x + 0 and so on
+        if isinstance(node.op, (ast.BitOr, ast.BitXor, ast.Add, ast.Sub)) and isinstance(node.right, ast.Constant) and type(node.right.value) in (int, bool) and node.right.value == 0 and self.is_int(node.left):
+            return node.left
+
+        if isinstance(node.op, (ast.BitOr, ast.BitXor, ast.Add)) and isinstance(node.left, ast.Constant) and type(node.left.value) in (int, bool) and node.left.value == 0 and self.is_int(node.right):
+            return node.right
+
+        return node
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+
+        if isinstance(node.operand, ast.Constant):
+            return self.constant(node)
+
+        return node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+
+        if self.all_constant([ node.left ] + node.comparators):
+            return self.constant(node)
+
+        return node
+
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+
+        values = [ ]
+
+        for v in node.values:
+            if isinstance(v, ast.Constant):
+                is_last = v is node.values[-1]
+
+                if isinstance(node.op, ast.And):
+                    if not v.value or is_last:
+                        values.append(v)
+                        break
+
+                else:
+                    if v.value or is_last:
+                        values.append(v)
+                        break
+
+                continue
+
+            values.append(v)
+
+        if len(values) == 1:
+            return values[0]
+
+        node.values = values
+
+        return node
+
+    def visit_IfExp(self, node):
+        test = self.visit(node.test)
+
+        if isinstance(test, ast.Constant):
+            return self.visit(node.body if test.value else node.orelse)
+
+        node.test = test
+        node.body = self.visit(node.body)
+        node.orelse = self.visit(node.orelse)
+
+        return node
+
+    def visit_Attribute(self, node):
+        self.generic_visit(node)
+
+        if is_pc(node) and isinstance(node.ctx, ast.Load) and self.spec.known_pc != None:
+            return ast.Constant(self.spec.known_pc)
+
+        return node
+
+    def visit_Call(self, node):
+        # operand fetches of a block are replaced by the byte itself
+        if self.spec.code != None and is_self_call(node) and node.func.attr == 'read_mem' and self.spec.known_pc != None and any(is_pc(n) for n in ast.walk(node.args[0])):
+            a = self.visit(node.args[0])
+
+            if isinstance(a, ast.Constant):
+                return ast.Constant(self.spec.fetch(a.value & 0xffff))
+
+        self.generic_visit(node)
+
+        if not is_self_call(node):
+            return node
+
+        name = node.func.attr
+        args = node.args
+        spec = self.spec
+
+        if spec.known_pc != None and name != 'read_mem' and spec.has_effect(name, PC_STORE):
+            spec.known_pc = None
+
+        if not spec.is_original(name) or node.keywords:
+            return node
+
+        if name == 'get_src' and isinstance(args[0], ast.Constant):
+            return ast.Tuple([ spec.load8(args[0].value), ast.Constant(REG_NAMES8[args[0].value]) ], ast.Load())
+
+        if name == 'get_pair' and isinstance(args[0], ast.Constant):
+            return ast.Tuple([ spec.load16(args[0].value), ast.Constant(PAIR_NAMES[args[0].value]) ], ast.Load())
+
+        if name == 'm16':
+            return ast.BinOp(ast.BinOp(args[0], ast.LShift(), ast.Constant(8)), ast.BitOr(), args[1])
+
+        if name == 'u16' and is_simple(args[0]):
+            return ast.Tuple([ ast.BinOp(args[0], ast.RShift(), ast.Constant(8)), ast.BinOp(copy.deepcopy(args[0]), ast.BitAnd(), ast.Constant(0xff)) ], ast.Load())
+
+        if name in ('incp16', 'decp16'):
+            op = ast.Add() if name == 'incp16' else ast.Sub()
+            return self.visit(ast.BinOp(ast.BinOp(args[0], op, ast.Constant(1)), ast.BitAnd(), ast.Constant(0xffff)))
+
+        if name == 'compl8' and isinstance(args[0], ast.Constant):
+            return self.visit(parse_expr('(%d ^ 0x80) - 0x80' % args[0].value))
+
+        if name == 'parity':
+            return ast.Subscript(parse_expr('self.parity_lookup'), args[0], ast.Load())
+
+        if name.startswith('get_flag_') and name[9:] in FLAG_BITS:
+            return parse_expr('(self.f & %d) != 0' % (1 << FLAG_BITS[name[9:]]))
+
+        return node
+
+class specializer:
+    def __init__(self, cpu):
+        self.cls = type(cpu)
+        self.trace = cpu.trace
+
+        self.source_cls = [ c for c in self.cls.__mro__ if c.__name__ == 'z80' ][-1]
+
+        self.defs = { }
+        self.stores = { }
+        self.effects = { }
+        self.inline_count = 0
+
+        # only used when translating blocks: the value of self.pc if known
+        # at this point and the code bytes read so far (address: value)
+        self.read_mem = cpu.read_mem
+        self.known_pc = None
+        self.code = None
+
+    # True when "name" is the z80 method itself (or its untraced copy)
+    # and not an override from a variant class
+    def is_original(self, name):
+        f_src = getattr(self.source_cls, name, None)
+        f_cls = getattr(self.cls, name, None)
+
+        if not inspect.isfunction(f_src) or not inspect.isfunction(f_cls):
+            return False
+
+        return f_src.__code__.co_filename == f_cls.__code__.co_filename and f_src.__code__.co_firstlineno == f_cls.__code__.co_firstlineno
+
+    # True if the source of method "name" (or of a method it calls)
+    # matches "pattern"
+    def has_effect(self, name, pattern):
+        key = (name, pattern)
+
+        if not key in self.effects:
+            func = getattr(self.cls, name, None)
+
+            if not inspect.isfunction(func):
+                # an attribute like self.write_mem
+                return pattern.search('self.%s(' % name) != None
+
+            self.effects[key] = False
+
+            src = inspect.getsource(func)
+
+            self.effects[key] = pattern.search(src) != None or any(self.has_effect(m, pattern) for m in CALLED_METHODS.findall(src))
+
+        return self.effects[key]
+
+    def fetch(self, a):
+        if not a in self.code:
+            self.code[a] = self.read_mem(a)
+
+        return self.code[a]
+
+    def get_def(self, name):
+        if not name in self.defs:
+            src = textwrap.dedent(inspect.getsource(getattr(self.source_cls, name)))
+
+            if not self.trace:
+                src = ast.unparse(strip_trace(ast.parse(src)))
+
+            self.defs[name] = src
+
+        # parsing again is a lot cheaper than a deepcopy of the tree
+        return ast.parse(self.defs[name]).body[0]
+
+    def load8(self, which):
+        if which == 6:
+            return parse_expr('self.read_mem((self.h << 8) | self.l)')
+
+        return parse_expr(REGS8[which])
+
+    def store8(self, which, value):
+        if which == 6:
+            return template('self.write_mem((self.h << 8) | self.l, __v)', __v=value)
+
+        return template('%s = __v' % REGS8[which], __v=value)
+
+    def load16(self, which):
+        if which == 3:
+            return parse_expr('self.sp')
+
+        return parse_expr('(%s << 8) | %s' % PAIRS[which])
+
+    def store16(self, which, value):
+        if which == 3:
+            return template('self.sp = __v', __v=value)
+
+        out = [ ]
+
+        if not is_simple(value):
+            out += template('pair_value = __v', __v=value)
+            value = ast.Name('pair_value', ast.Load())
+
+        out += template('%s = __v >> 8' % PAIRS[which][0], __v=value)
+        out += template('%s = __v & 0xff' % PAIRS[which][1], __v=value)
+
+        return out
+
+    def expr(self, node, env):
+        return folder(self, env).visit(node)
+
+    # returns the statements of method "name" specialized for the given
+    # arguments; constant arguments are folded into the body
+    def function_body(self, name, args, top, depth):
+        fdef = self.get_def(name)
+        params = [ a.arg for a in fdef.args.args[1:] ]
+
+        if len(params) != len(args) or fdef.args.vararg or fdef.args.kwonlyargs:
+            raise cannot_specialize(name)
+
+        if not name in self.stores:
+            self.stores[name] = count_stores(fdef)
+
+        stores = dict(self.stores[name])
+
+        if depth > 0:
+            # give the locals of an inlined method names of their own
+            self.inline_count += 1
+            prefix = 'i%d_' % self.inline_count
+            fdef = rename(set(params) | set(stores), prefix).visit(fdef)
+            params = [ prefix + p for p in params ]
+            stores = { prefix + n: stores[n] for n in stores }
+
+        env = { }
+        out = [ ]
+        targets = [ ]
+        values = [ ]
+
+        for (p, v) in zip(params, args):
+            if isinstance(v, ast.Constant) and not p in stores:
+                env[p] = v.value
+
+            elif isinstance(v, ast.Name) and not p in stores:
+                env[p] = v
+
+            else:
+                targets.append(ast.Name(p, ast.Store()))
+                values.append(v)
+
+        if len(targets) == 1:
+            out.append(ast.Assign(targets, values[0]))
+
+        elif targets:
+            out.append(ast.Assign([ ast.Tuple(targets, ast.Store()) ], ast.Tuple(values, ast.Load())))
+
+        return out + self.stmts(fdef.body, env, stores, top, depth)
+
+    def stmts(self, body, env, stores, top, depth):
+        out = [ ]
+
+        for s in body:
+            out += self.stmt(s, env, stores, top, depth)
+
+            if out and isinstance(out[-1], (ast.Return, ast.Raise)):
+                break  # the rest is unreachable
+
+        return out
+
+    def inlinable(self, call, depth):
+        return is_self_call(call) and depth < MAX_INLINE_DEPTH and not call.keywords and not call.func.attr.startswith('debug') and self.is_original(call.func.attr)
+
+    # inlines a method whose only return statement is the last one;
+    # "result" gets the statement that consumes the returned value
+    def inline_call(self, call, env, stores, top, depth, result):
+        args = [ self.expr(a, env) for a in call.args ]
+
+        try:
+            body = self.function_body(call.func.attr, args, top, depth + 1)
+
+        except cannot_specialize:
+            return None
+
+        if has_nested_return(body):
+            return None
+
+        if body and isinstance(body[-1], ast.Return):
+            value = body[-1].value
+            body = body[:-1]
+
+        else:
+            value = ast.Constant(None)
+
+        return body + self.stmts(result(value), env, stores, top, depth)
+
+    def stmt(self, s, env, stores, top, depth):
+        if isinstance(s, ast.If):
+            test = self.expr(s.test, env)
+
+            if isinstance(test, ast.Constant):
+                return self.stmts(s.body if test.value else s.orelse, env, stores, top, depth)
+
+            body = body_or_pass(self.stmts(s.body, env, stores, False, depth))
+            orelse = self.stmts(s.orelse, env, stores, False, depth)
+
+            return [ ast.If(test, body, orelse) ]
+
+        if isinstance(s, ast.While):
+            if stores_pc(s.body):
+                self.known_pc = None
+
+            test = self.expr(s.test, env)
+            body = body_or_pass(self.stmts(s.body, env, stores, False, depth))
+
+            return [ ast.While(test, body, self.stmts(s.orelse, env, stores, False, depth)) ]
+
+        if isinstance(s, ast.Pass):
+            return [ ]
+
+        if isinstance(s, (ast.Break, ast.Continue)):
+            return [ s ]
+
+        if isinstance(s, ast.Assert):
+            test = self.expr(s.test, env)
+
+            # the range checks of the inlined helpers are not needed
+            if (isinstance(test, ast.Constant) and test.value) or depth > 0:
+                return [ ]
+
+            return [ ast.Assert(test, s.msg) ]
+
+        if isinstance(s, ast.Return):
+            if s.value is None:
+                return [ s ]
+
+            if self.inlinable(s.value, depth) and not s.value.func.attr in ('get_src', 'get_pair'):
+                args = [ self.expr(a, env) for a in s.value.args ]
+
+                try:
+                    return self.function_body(s.value.func.attr, args, top, depth + 1)
+
+                except cannot_specialize:
+                    pass
+
+            return [ ast.Return(self.expr(s.value, env)) ]
+
+        if isinstance(s, ast.Expr):
+            call = s.value
+
+            if is_self_call(call) and self.is_original(call.func.attr):
+                name = call.func.attr
+                args = [ self.expr(a, env) for a in call.args ]
+
+                if name == 'set_dst' and isinstance(args[0], ast.Constant):
+                    return self.store8(args[0].value, args[1])
+
+                if name == 'set_pair' and isinstance(args[0], ast.Constant):
+                    return self.store16(args[0].value, args[1])
+
+                if name.startswith('set_flag_') and name[9:] in FLAG_BITS:
+                    bit = FLAG_BITS[name[9:]]
+                    return [ self.expr(t, { }) for t in template('self.f = (self.f & %d) | (__v << %d)' % (~(1 << bit), bit), __v=args[0]) ]
+
+                if name == 'set_flag_53':
+                    return [ self.expr(t, { }) for t in template('self.f = (self.f & -41) | (__v & 0x28)', __v=args[0]) ]
+
+                if self.inlinable(call, depth):
+                    inlined = self.inline_call(call, env, stores, top, depth, lambda v: [ ] if is_simple(v) else [ ast.Expr(v) ])
+
+                    if inlined != None:
+                        return inlined
+
+            return [ ast.Expr(self.expr(call, env)) ]
+
+        if isinstance(s, ast.Assign):
+            value = s.value
+
+            if len(s.targets) == 1 and is_self_call(value) and self.is_original(value.func.attr):
+                name = value.func.attr
+                target = s.targets[0]
+
+                if name in ('set_dst', 'set_pair'):
+                    args = [ self.expr(a, env) for a in value.args ]
+
+                    if isinstance(args[0], ast.Constant):
+                        if name == 'set_dst':
+                            out = self.store8(args[0].value, args[1])
+                            label = REG_NAMES8[args[0].value]
+
+                        else:
+                            out = self.store16(args[0].value, args[1])
+                            label = PAIR_NAMES[args[0].value]
+
+                        return out + self.stmt(ast.Assign([ target ], ast.Constant(label)), env, stores, top, depth)
+
+                if name == 'compl8':
+                    self.inline_count += 1
+                    temp = 'i%d_compl' % self.inline_count
+                    stores[temp] = 1
+
+                    out = self.stmt(ast.Assign([ ast.Name(temp, ast.Store()) ], value.args[0]), env, stores, top, depth)
+
+                    return out + self.stmt(ast.Assign([ target ], parse_expr('(%s ^ 0x80) - 0x80' % temp)), env, stores, top, depth)
+
+                if self.inlinable(value, depth) and not name in ('get_src', 'get_pair', 'm16', 'u16', 'incp16', 'decp16', 'parity') and not name.startswith('get_flag_'):
+                    inlined = self.inline_call(value, env, stores, top, depth, lambda v: [ ast.Assign([ target ], v) ])
+
+                    if inlined != None:
+                        return inlined
+
+            value = self.expr(value, env)
+
+            if len(s.targets) == 1 and is_pc(s.targets[0]) and self.code != None:
+                self.known_pc = value.value if top and isinstance(value, ast.Constant) else None
+
+                return [ ast.Assign(s.targets, value) ]
+
+            if len(s.targets) == 1 and isinstance(s.targets[0], ast.Tuple) and isinstance(value, ast.Tuple) and len(s.targets[0].elts) == len(value.elts):
+                # (a, b) = (x, y) becomes a = x; b = y when that's the same
+                targets = s.targets[0].elts
+                names = set(n.id for n in targets if isinstance(n, ast.Name))
+                used = set(n.id for v in value.elts for n in ast.walk(v) if isinstance(n, ast.Name))
+
+                if len(names) == len(targets) and not names & used:
+                    out = [ ]
+
+                    for (t, v) in zip(targets, value.elts):
+                        out += self.stmt(ast.Assign([ t ], v), env, stores, top, depth)
+
+                    return out
+
+            if len(s.targets) == 1 and isinstance(s.targets[0], ast.Name):
+                name = s.targets[0].id
+
+                if top and isinstance(value, ast.Constant) and stores.get(name, 0) == 1:
+                    env[name] = value.value
+                    return [ ]
+
+                if top and isinstance(value, ast.Name) and stores.get(name, 0) == 1 and stores.get(value.id, 0) <= 1:
+                    env[name] = value
+                    return [ ]
+
+            return [ ast.Assign([ self.expr(t, env) for t in s.targets ], value) ]
+
+        if isinstance(s, ast.AugAssign):
+            value = self.expr(s.value, env)
+
+            if is_pc(s.target):
+                self.known_pc = None
+
+            return [ ast.AugAssign(self.expr(s.target, env), s.op, value) ]
+
+        raise cannot_specialize(type(s).__name__)
+
+    def compile(self, body, label, globals_):
+        fdef = ast.FunctionDef('handler', ast.arguments([ ], [ ast.arg('instr') ], None, [ ], [ ], None, [ ]), body_or_pass(body), [ ])
+        factory = ast.FunctionDef('factory', ast.arguments([ ], [ ast.arg('self') ], None, [ ], [ ], None, [ ]), [ fdef, ast.Return(ast.Name('handler', ast.Load())) ], [ ])
+
+        set_line_numbers([ factory ])
+        src = ast.unparse(ast.Module([ factory ], [ ]))
+
+        # so that tracebacks can show the generated code
+        filename = '<z80 %s>' % label
+        linecache.cache[filename] = (len(src), None, src.splitlines(True), filename)
+
+        scope = dict(globals_)
+        exec(compile(src, filename, 'exec'), scope)
+
+        return scope['factory']
+
+    def handler_factory(self, name, args, label):
+        func = getattr(self.source_cls, name)
+
+        try:
+            body = remove_dead_stores(self.function_body(name, [ ast.Constant(a) for a in args ], True, 0))
+
+        except cannot_specialize:
+            return None
+
+        return self.compile(body, label, func.__globals__)
+
+PREFIX_SRC = '''
+def factory(self, jumps):
+    def handler(dummy):
+        pc = self.pc
+        instr = self.read_mem(pc)
+        self.pc = (pc + 1) & 0xffff
+        %s
+        method = jumps[instr]
+        assert method != None
+        return method(instr)
+    return handler
+'''
+
+IXY_BIT_SRC = '''
+def factory(self, jumps):
+    def handler(dummy):
+        instr = self.read_mem(self.pc + 1)
+        method = jumps[instr]
+        assert method != None
+        rc = method(instr)
+        self.pc = (self.pc + 1) & 0xffff
+        return rc
+    return handler
+'''
+
+PREFIX_TRACE = {
+    'bits': "self.debug('%04x cb%02x' % (self.pc - 2, instr))",
+    'ed': "self.debug('EXT: %02x' % instr)",
+    '_ix': "self.debug('%04x dd%02x' % (self.pc - 2, instr))",
+    '_iy': "self.debug('%04x fd%02x' % (self.pc - 2, instr))",
+}
+
+# factories are shared by all instances of a class
+factories = { }
+
+def get_factories(cpu):
+    key = (type(cpu), cpu.trace)
+
+    if key in factories:
+        return factories[key]
+
+    spec = specializer(cpu)
+
+    tables = { }
+
+    def build(table_name, jumps, extra_args):
+        out = [ None ] * 256
+
+        for instr in range(0, 256):
+            method = jumps[instr]
+
+            if method == None:
+                continue
+
+            name = method.__name__
+
+            if name in PREFIXES:
+                out[instr] = name
+                continue
+
+            args = [ instr ] + extra_args
+            label = '%s %02x %s' % (table_name, instr, name)
+            factory = spec.handler_factory(name, args, label) if spec.is_original(name) else None
+
+            out[instr] = factory if factory else (name, extra_args)
+
+        tables[table_name] = out
+
+    build('main', cpu.main_jumps, [ ])
+    build('bits', cpu.bits_jumps, [ ])
+    build('ed', cpu.ed_jumps, [ ])
+    build('ix', cpu.ixy_jumps, [ True ])
+    build('iy', cpu.ixy_jumps, [ False ])
+    build('ix_bit', cpu.ixy_bit_jumps, [ True ])
+    build('iy_bit', cpu.ixy_bit_jumps, [ False ])
+
+    prefixes = { }
+
+    for name in PREFIX_TRACE:
+        src = PREFIX_SRC % (PREFIX_TRACE[name] if cpu.trace else 'pass')
+        scope = { }
+        exec(compile(src, '<z80 prefix %s>' % name, 'exec'), scope)
+        prefixes[name] = scope['factory']
+
+    scope = { }
+    exec(compile(IXY_BIT_SRC, '<z80 prefix ixy_bit>', 'exec'), scope)
+    prefixes['ixy_bit'] = scope['factory']
+
+    factories[key] = (tables, prefixes)
+
+    return factories[key]
+
+def bind_method(method, extra_args):
+    if not extra_args:
+        return method
+
+    def handler(instr):
+        return method(instr, *extra_args)
+
+    return handler
+
+# returns the decoded main, CB, ED, DD, FD, DDCB and FDCB tables for cpu
+def decode_tables(cpu):
+    (tables, prefixes) = get_factories(cpu)
+
+    out = { }
+
+    for table_name in tables:
+        out[table_name] = [ None ] * 256
+
+    def instantiate(table_name):
+        jumps = out[table_name]
+
+        for instr in range(0, 256):
+            entry = tables[table_name][instr]
+
+            if entry == None or isinstance(entry, str):
+                continue
+
+            if isinstance(entry, tuple):
+                jumps[instr] = bind_method(getattr(cpu, entry[0]), entry[1])
+
+            else:
+                jumps[instr] = entry(cpu)
+
+    for table_name in tables:
+        instantiate(table_name)
+
+    # the prefix dispatchers, now that the tables they refer to exist
+    prefix_tables = { 'bits': out['bits'], 'ed': out['ed'], '_ix': out['ix'], '_iy': out['iy'] }
+
+    for table_name in tables:
+        for instr in range(0, 256):
+            entry = tables[table_name][instr]
+
+            if entry == 'ixy_bit':
+                bit_table = out['ix_bit'] if table_name == 'ix' else out['iy_bit']
+                out[table_name][instr] = prefixes['ixy_bit'](cpu, bit_table)
+
+            elif isinstance(entry, str):
+                out[table_name][instr] = prefixes[entry](cpu, prefix_tables[entry])
+
+    return out
+
+# basic block translation (the "jit" mode of the z80 class)
+
+JIT_MAX_INSTRUCTIONS = 32
+
+# calls that do not look at the cpu state (so self.pc may still be stale)
+PC_NEUTRAL_CALLS = ( 'read_mem', 'write_mem', 'read_io', 'write_io' )
+
+def reads_pc(s):
+    for node in ast.walk(s):
+        if is_pc(node) and isinstance(node.ctx, ast.Load):
+            return True
+
+        if isinstance(node, ast.Call) and not (is_self_call(node) and node.func.attr in PC_NEUTRAL_CALLS):
+            return True
+
+    return False
+
+# every instruction in a block stores self.pc a couple of times; only the
+# last store before anything that can look at it is needed
+def remove_pc_stores(stmts):
+    keep = [ True ] * len(stmts)
+    pending = None
+
+    for (i, s) in enumerate(stmts):
+        if isinstance(s, ast.Assign) and len(s.targets) == 1 and is_pc(s.targets[0]) and not reads_pc(s.value):
+            if pending != None:
+                keep[pending] = False
+
+            pending = i
+
+        elif not isinstance(s, (ast.Assign, ast.AugAssign, ast.Expr)) or reads_pc(s):
+            pending = None
+
+    return [ s for (s, k) in zip(stmts, keep) if k ]
+
+def add_cycles(static, dynamic, value):
+    node = ast.Constant(static)
+
+    if dynamic:
+        node = ast.BinOp(node, ast.Add(), ast.Name('jit_cycles', ast.Load()))
+
+    if value != None:
+        node = ast.BinOp(node, ast.Add(), value)
+
+    return node
+
+# an instruction that returns halfway exits the block there
+def rewrite_returns(stmts, static, dynamic):
+    for s in stmts:
+        if isinstance(s, ast.Return):
+            s.value = add_cycles(static, dynamic, s.value)
+
+        for field in ('body', 'orelse'):
+            rewrite_returns(getattr(s, field, [ ]), static, dynamic)
+
+def has_return(stmts):
+    return any(isinstance(n, ast.Return) for s in stmts for n in ast.walk(s))
+
+class block_translator(specializer):
+    def __init__(self, cpu, tables):
+        super(block_translator, self).__init__(cpu)
+
+        self.tables = tables
+
+    def instruction_writes_memory(self, stmts):
+        return any(is_self_call(n) and self.has_effect(n.func.attr, MEMORY_WRITE) for s in stmts for n in ast.walk(s))
+
+    # returns (method name, arguments, pc after the opcode fetch, DDCB/FDCB)
+    def decode(self, a):
+        instr = self.fetch(a)
+        tables = self.tables
+
+        if instr in (0xcb, 0xed):
+            sub = self.fetch((a + 1) & 0xffff)
+            method = tables['bits' if instr == 0xcb else 'ed'][sub]
+            return (method, [ sub ], (a + 2) & 0xffff, False)
+
+        if instr in (0xdd, 0xfd):
+            sub = self.fetch((a + 1) & 0xffff)
+
+            if sub == 0xcb:
+                sub = self.fetch((a + 3) & 0xffff)
+                return (tables['ixy_bit'][sub], [ sub, instr == 0xdd ], (a + 2) & 0xffff, True)
+
+            return (tables['ixy'][sub], [ sub, instr == 0xdd ], (a + 2) & 0xffff, False)
+
+        return (tables['main'][instr], [ instr ], (a + 1) & 0xffff, False)
+
+    def instruction(self, a):
+        (method, args, pc, ixy_bit) = self.decode(a)
+
+        if method == None or method.__name__ in PREFIXES or not self.is_original(method.__name__):
+            raise cannot_specialize('%04x' % a)
+
+        self.known_pc = pc
+        body = [ ast.Assign([ parse_expr('self.pc') ], ast.Constant(pc)) ]
+        body += self.function_body(method.__name__, [ ast.Constant(v) for v in args ], True, 1)
+
+        if not body or not isinstance(body[-1], ast.Return):
+            raise cannot_specialize('%04x' % a)
+
+        (body, value) = (body[:-1], body[-1].value)
+
+        if ixy_bit:
+            if has_return(body):
+                raise cannot_specialize('%04x' % a)
+
+            # ixy_bit() steps over the last opcode byte afterwards
+            for s in parse_stmts('self.pc = (self.pc + 1) & 0xffff'):
+                body += self.stmt(s, { }, { }, True, 1)
+
+        return (body, value)
+
+    # Translates the code at "start" up to the first instruction that
+    # changes the program counter in a way only known at run time (or to
+    # an address in stop_pcs). Returns (function source, code addresses,
+    # number of instructions) or None when not even the first
+    # instruction can be translated. "volatile" returns True for
+    # addresses that should be left to the interpreter.
+    def translate(self, start, stop_pcs, volatile):
+        out = [ ]
+        code = { }
+        static = 0
+        dynamic = False
+        starts = set()
+        a = start
+
+        while len(starts) < JIT_MAX_INSTRUCTIONS:
+            self.code = { }
+
+            try:
+                (body, value) = self.instruction(a)
+
+            except cannot_specialize:
+                break
+
+            if any(volatile(c) for c in self.code):
+                break
+
+            code.update(self.code)
+            starts.add(a)
+
+            rewrite_returns(body, static, dynamic)
+
+            if self.known_pc == None:
+                # the end of the block
+                out += body + [ ast.Return(add_cycles(static, dynamic, value)) ]
+                break
+
+            out += body
+
+            if isinstance(value, ast.Constant):
+                static += value.value
+
+            elif dynamic:
+                out += template('jit_cycles += __v', __v=value)
+
+            else:
+                out += template('jit_cycles = __v', __v=value)
+                dynamic = True
+
+            a = self.known_pc
+
+            if a in starts or a in stop_pcs:
+                break
+
+            if self.instruction_writes_memory(body):
+                # the write may have changed the code of this block
+                out += template('if self.jit_dirty:\n    self.jit_dirty = False\n    return __v', __v=add_cycles(static, dynamic, None))
+
+        self.code = None
+        self.known_pc = None
+
+        if not starts:
+            return None
+
+        if not out or not isinstance(out[-1], ast.Return):
+            out.append(ast.Return(add_cycles(static, dynamic, None)))
+
+        out = remove_dead_stores(remove_pc_stores(out))
+
+        fdef = ast.FunctionDef('block', ast.arguments([ ], [ ], None, [ ], [ ], None, [ ]), out, [ ])
+        factory = ast.FunctionDef('factory', ast.arguments([ ], [ ast.arg('self') ], None, [ ], [ ], None, [ ]), [ fdef, ast.Return(ast.Name('block', ast.Load())) ], [ ])
+
+        set_line_numbers([ factory ])
+
+        return (ast.unparse(ast.Module([ factory ], [ ])), sorted(code), len(starts))
+
+translators = { }
+
+# Returns a function that executes the block at "start" and returns the
+# number of cycles it took, plus the list of addresses of its code. None
+# when the instruction at start can't be translated.
+def translate_block(cpu, start, stop_pcs, volatile):
+    key = (type(cpu), cpu.trace)
+
+    if not key in translators:
+        translators[key] = block_translator(cpu, cpu.jit_tables)
+
+    translator = translators[key]
+    translator.read_mem = cpu.read_mem
+
+    result = translator.translate(start, stop_pcs, volatile)
+
+    if not result:
+        return None
+
+    (src, addresses, n) = result
+
+    filename = '<z80 block %04x>' % start
+    linecache.cache[filename] = (len(src), None, src.splitlines(True), filename)
+
+    scope = dict(getattr(translator.source_cls, 'step').__globals__)
+    exec(compile(src, filename, 'exec'), scope)
+
+    return (scope['factory'](cpu), addresses)
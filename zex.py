@@ -3,12 +3,30 @@
 # (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
 # released under AGPL v3.0
 
+import atexit
 import sys
 import time
 from inspect import getframeinfo, stack
+from optparse import OptionParser
 from z80 import z80
 from screen_kb_dummy import screen_kb_dummy
 
+parser = OptionParser()
+parser.add_option('-T', '--trace', dest='trace', action='store_true', default=False, help='use the tracing (slow) z80 variant')
+parser.add_option('-L', '--lazy-flags', dest='lazy_flags', action='store_true', default=False, help='use the lazy flags z80 variant')
+parser.add_option('-P', '--decoded', dest='decoded', action='store_true', default=False, help='use generated per-opcode z80 instruction handlers')
+parser.add_option('-J', '--jit', dest='jit', action='store_true', default=False, help='translate basic blocks of z80 code to python functions')
+parser.add_option('-F', '--profile', dest='profile', help='count the executed z80 instructions and write a report to this file at exit (JSON when it ends in .json); not with -J, a bulk LDIR/LDDR/CPIR/CPDR/INIR counts once')
+(options, args) = parser.parse_args()
+
+# the profiler counts what the interpreter executes
+if options.profile and options.jit:
+    print('The profiler (-F) can not be combined with the jit (-J)')
+    sys.exit(1)
+
+# optional: number of seconds to run, after which the speed is shown
+duration = float(args[0]) if len(args) > 0 else None
+
 io = [ 0 ] * 256
 
 ram0 = [ 0 ] * 16384
@@ -49,6 +67,16 @@ def write_mem(a, v):
 
     slot[a & 0x3fff] = v
 
+def block_mem(a, write):
+    page = a >> 14
+
+    slot = slots[page][pages[page]]
+
+    if slot == None:
+        return None
+
+    return (slot, page << 14, page << 14, (page << 14) | 0x3fff)
+
 def read_io(a):
     return io[a]
  
@@ -61,7 +89,10 @@ def debug(x):
 dk = screen_kb_dummy(io)
 dk.start()
 
-cpu = z80(read_mem, write_mem, read_io, write_io, debug, dk)
+cpu = z80(read_mem, write_mem, read_io, write_io, debug, dk, trace=options.trace, lazy_flags=options.lazy_flags, decoded=options.decoded, jit=options.jit, profile=options.profile != None, block_mem=block_mem)
+
+if options.profile:
+    atexit.register(cpu.write_profile, options.profile)
 
 fh = open('zexdoc.com', 'rb')
 zex = [ int(b) for b in fh.read() ]
@@ -75,6 +106,8 @@ for b in zex:
 cpu.sp = 0xf000
 cpu.pc = 0x0100
 
+start = time.time()
+
 while True:
     if cpu.pc == 0x0005:
         if cpu.c == 2:
@@ -101,6 +134,12 @@ while True:
 
         cpu._ret(True, 'bla')
 
-        continue
+    cpu.run(3579545 // 50, stop_pcs=(0x0005, ))
+
+    if duration and time.time() - start >= duration:
+        break
 
-    cpu.step()
+if duration:
+    took = time.time() - start
+    print('')
+    print('%d cycles in %.2f seconds: %.0f cycles/s (%.1f%% of a 3.58 MHz Z80)' % (cpu.cycles, took, cpu.cycles / took, cpu.cycles * 100.0 / took / 3579545))